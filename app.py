@@ -1,23 +1,84 @@
 import streamlit as st
-import pandas as pd
+import atexit
+import bisect
+import difflib
+import functools
+import hashlib
+import html
+import heapq
+import itertools
 import json
+import math
+import mmap
 import os
+import queue
+import random
 import time
 import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
 from datetime import datetime
-import google.generativeai as genai
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # ==========================================
 # 🔑 CONFIGURATION
 # ==========================================
-GEMINI_API_KEY = st.secrets.get("GEMINI_API_KEY")
+def get_setting(name, default=None):
+    """Read a setting from the environment, then from st.secrets."""
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        return st.secrets.get(name, default)
+    except Exception:
+        return default
 
-# Configure Gemini
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-flash')
-except Exception as e:
-    st.error(f"Error configuring Gemini: {e}")
+
+GEMINI_API_KEY = get_setting("GEMINI_API_KEY")
+
+# "json" rewrites purchase_history.json on every order; "journal" appends
+# orders to a line-delimited journal and compacts it periodically; "sqlite"
+# keeps products and orders in an indexed SQLite database (SQLITE_PATH).
+STORAGE_MODE = get_setting("STORAGE_MODE", "json")
+JOURNAL_COMPACT_EVERY = int(get_setting("JOURNAL_COMPACT_EVERY", 500))
+
+# Checkouts and cancellations are queued and written in the background in
+# batches: how long the writer waits for more writes before a batch, and
+# the largest batch. WRITE_BEHIND=0 makes each checkout wait for its write.
+WRITE_BEHIND = get_setting("WRITE_BEHIND", "1") not in ("0", "false")
+WRITE_BATCH_WINDOW_MS = float(get_setting("WRITE_BATCH_WINDOW_MS", 20))
+WRITE_BATCH_MAX = int(get_setting("WRITE_BATCH_MAX", 100))
+
+# Product thumbnails: cache directory, and whether to build them all at
+# startup (in the background) instead of on first view.
+THUMBNAIL_DIR = get_setting("THUMBNAIL_DIR", ".thumbnails")
+THUMBNAIL_EAGER = get_setting("THUMBNAIL_EAGER", "0") not in ("0", "false")
+
+# Compiled catalog snapshot shared by all server processes through mmap
+# (off when empty). Workers check whether the catalog changed at most
+# every CATALOG_RECHECK seconds.
+CATALOG_SNAPSHOT = get_setting("CATALOG_SNAPSHOT", "")
+CATALOG_RECHECK = float(get_setting("CATALOG_RECHECK", 1.0))
+
+# Products per page in the Shop tab, orders per page in the Orders tab.
+SHOP_PAGE_SIZE = int(get_setting("SHOP_PAGE_SIZE", 12))
+ORDERS_PAGE_SIZE = int(get_setting("ORDERS_PAGE_SIZE", 20))
+
+# Opt-in profiling: PROFILE=1 for every session, or ?debug=1 in the URL for
+# one. PROFILE_LOG appends every profiled rerun to a JSON lines file.
+PROFILE = get_setting("PROFILE", "0") not in ("0", "false")
+PROFILE_LOG = get_setting("PROFILE_LOG")
 
 # ==========================================
 # 🎨 CUSTOM CSS
@@ -139,488 +200,4214 @@ def load_custom_styles():
     """, unsafe_allow_html=True)
 
 # ==========================================
-# 📂 PART 1: DATA MANAGER
+# ⏱️ PROFILING
 # ==========================================
+class Profiler:
+    """Named timing spans and file read counters for profiled reruns.
 
+    A run (a full rerun, or a dialog's fragment rerun) is collected on the
+    script thread that executes it; ``span`` and ``count_read`` are no-ops
+    outside a profiled run, so the hooks cost nothing when profiling is
+    off. Finished runs are kept in ``recent``, folded into process-wide
+    totals for the Prometheus export, and appended to ``log_path``.
+    """
 
-class DataManager:
-    PRODUCT_FILE = "products.json"
-    HISTORY_FILE = "purchase_history.json"
-
-    @staticmethod
-    def load_data():
-        products = []
-        history = []
-        if os.path.exists(DataManager.PRODUCT_FILE):
-            try:
-                with open(DataManager.PRODUCT_FILE, 'r') as f:
-                    products = json.load(f)
-            except:
-                pass
-        if os.path.exists(DataManager.HISTORY_FILE):
-            try:
-                with open(DataManager.HISTORY_FILE, 'r') as f:
-                    history = json.load(f)
-            except:
-                history = []
-        return products, history
+    def __init__(self, log_path=None, keep=100):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._run = threading.local()
+        self.recent = deque(maxlen=keep)
+        self.totals = {"runs": 0, "file_reads": 0, "file_bytes": 0,
+                       "spans": {}}
 
-    @staticmethod
-    def save_order(cart_items):
-        _, history = DataManager.load_data()
-        new_order_id = f"ORD-{int(time.time())}"
-        current_date = datetime.now().strftime("%Y-%m-%d")
+    def begin_run(self, enabled, kind="rerun"):
+        """Start a run on this thread. False if one is already open."""
+        if not enabled or getattr(self._run, "record", None) is not None:
+            return False
+        self._run.start = time.perf_counter()
+        self._run.record = {"kind": kind, "spans": {}, "file_reads": 0,
+                            "file_bytes": 0}
+        return True
 
-        new_records = []
-        for item in cart_items:
-            record = {
-                "order_id": new_order_id,
-                "item": f"{item['name']} (x{item['qty']})",
-                "date": current_date,
-                "price": item['price'] * item['qty'],
-                "status": "Processing"
-            }
-            new_records.append(record)
-            history.append(record)
+    def end_run(self):
+        record = getattr(self._run, "record", None)
+        if record is None:
+            return None
+        self._run.record = None
+        record["ms"] = round((time.perf_counter() - self._run.start) * 1000, 3)
+        record["ts"] = round(time.time(), 3)
+        with self._lock:
+            self.recent.append(record)
+            self.totals["runs"] += 1
+            self.totals["file_reads"] += record["file_reads"]
+            self.totals["file_bytes"] += record["file_bytes"]
+            for name, span in record["spans"].items():
+                total = self.totals["spans"].setdefault(
+                    name, {"calls": 0, "ms": 0.0})
+                total["calls"] += span["calls"]
+                total["ms"] += span["ms"]
+            if self.log_path:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+        return record
 
+    @contextmanager
+    def span(self, name):
+        record = getattr(self._run, "record", None)
+        if record is None:
+            yield
+            return
+        start = time.perf_counter()
         try:
-            with open(DataManager.HISTORY_FILE, 'w') as f:
-                json.dump(history, f, indent=4)
-            return True
-        except Exception as e:
-            st.error(f"Failed to save: {e}")
-            return False
+            yield
+        finally:
+            span = record["spans"].setdefault(name, {"calls": 0, "ms": 0.0})
+            span["calls"] += 1
+            span["ms"] = round(
+                span["ms"] + (time.perf_counter() - start) * 1000, 3)
+
+    def count_read(self, nbytes):
+        record = getattr(self._run, "record", None)
+        if record is not None:
+            record["file_reads"] += 1
+            record["file_bytes"] += nbytes
+
+    def jsonl(self):
+        with self._lock:
+            return "".join(json.dumps(r) + "\n" for r in self.recent)
+
+    def prometheus(self):
+        with self._lock:
+            totals = json.loads(json.dumps(self.totals))
+        lines = [
+            "# TYPE dream_spells_profiled_runs_total counter",
+            f"dream_spells_profiled_runs_total {totals['runs']}",
+            "# TYPE dream_spells_file_reads_total counter",
+            f"dream_spells_file_reads_total {totals['file_reads']}",
+            "# TYPE dream_spells_file_read_bytes_total counter",
+            f"dream_spells_file_read_bytes_total {totals['file_bytes']}",
+            "# TYPE dream_spells_span_calls_total counter",
+        ]
+        lines += [f'dream_spells_span_calls_total{{span="{name}"}} {s["calls"]}'
+                  for name, s in sorted(totals["spans"].items())]
+        lines.append("# TYPE dream_spells_span_seconds_total counter")
+        lines += [f'dream_spells_span_seconds_total{{span="{name}"}} '
+                  f'{s["ms"] / 1000:.6f}'
+                  for name, s in sorted(totals["spans"].items())]
+        return "\n".join(lines) + "\n"
+
+
+@st.cache_resource
+def get_profiler():
+    return Profiler(PROFILE_LOG)
 
-    @staticmethod
-    def delete_order(order_id_to_remove):
-        _, history = DataManager.load_data()
-        updated_history = [
-            h for h in history if h['order_id'] != order_id_to_remove]
-        try:
-            with open(DataManager.HISTORY_FILE, 'w') as f:
-                json.dump(updated_history, f, indent=4)
-            return True
-        except:
-            return False
+
+def profiling_enabled():
+    return PROFILE or st.query_params.get("debug") in ("1", "true")
+
+
+def profiled(kind):
+    """Profile a dialog, whose fragment reruns skip main()."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = get_profiler().begin_run(profiling_enabled(), kind)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if started:
+                    get_profiler().end_run()
+        return wrapper
+    return decorate
 
 # ==========================================
-# 🤖 PART 2: AI LOGIC (UPDATED FOR CART)
+# 📂 PART 1: DATA MANAGER
 # ==========================================
 
 
-def get_ai_response(query, chat_history_str):
-    prod, hist = DataManager.load_data()
-    cart_txt = json.dumps(
-        st.session_state.cart) if 'cart' in st.session_state else "Empty"
+class FileLock:
+    """Exclusive lock shared by threads and processes via a lock file.
 
-    # Context with specialized instructions for JSON output
-    context = f"""
-    You are Aura, the AI agent for Dream Spells.
-    User: Ishara Stanley.
-    Cart: {cart_txt}
-    History: {json.dumps(hist)}
-    Catalog: {json.dumps(prod)}
-    Current Conversation History: {chat_history_str}
+    Re-entrant within a thread: only the outermost ``with`` takes the OS
+    lock, so helpers can lock again while a caller already holds it.
+    """
 
-    *** IMPORTANT CART INSTRUCTIONS ***
-    1. If the user asks about a product, describe it briefly and ask: "Do you want to add this to your cart?"
-    2. If the user says "Yes" or agrees, ask: "How many would you like?"
-    3. If the user provides a number (Quantity) for a specific item discussed, YOU MUST OUTPUT ONLY JSON.
-    
-    JSON FORMAT FOR ADDING TO CART:
-    {{ "action": "add_to_cart", "item_name": "Exact Product Name from Catalog", "qty": Integer }}
-
-    Example: User says "2", you output: {{ "action": "add_to_cart", "item_name": "Heavenly Hues", "qty": 2 }}
-    
-    For all other normal conversation, just reply with text (no JSON).
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            continue
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+
+def try_lock_file(fd):
+    """Lock an open file without waiting; False if another holder has it."""
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def write_atomic(path, write, binary=False, permissions=None):
+    """Call ``write(f)`` on a temp file, then rename it over ``path``.
+
+    Readers see either the old or the new file, never a partial write.
+    ``permissions`` (e.g. 0o644) replaces the temp file's owner-only mode.
     """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
     try:
-        response = model.generate_content(f"{context}\nUser Input: {query}")
-        return response.text
-    except:
-        return "The spirits are quiet today."
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if permissions is not None:
+            os.chmod(tmp_path, permissions)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
 
-# ==========================================
-# ⚙️ PART 3: CALLBACKS
-# ==========================================
-if "cart" not in st.session_state:
-    st.session_state.cart = []
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = [
-        {"role": "assistant", "content": "Welcome back, Ishara! Ask me about dreamcatchers."}]
+def write_json_atomic(path, data):
+    """Write JSON to ``path`` atomically (see write_atomic)."""
+    write_atomic(path, lambda f: json.dump(data, f, indent=4))
 
 
-def add_to_cart_callback(product, qty_key):
-    qty = st.session_state[qty_key]
-    found = False
-    for item in st.session_state.cart:
-        if item['id'] == product['id']:
-            item['qty'] += qty
-            found = True
-            break
-    if not found:
-        st.session_state.cart.append({
-            "id": product['id'],
-            "name": product['name'],
-            "price": product['price'],
+def write_json_array_atomic(path, items):
+    """Stream an iterable to ``path`` as a JSON array, one item per line.
+
+    Like write_json_atomic, but never holds the whole array in memory.
+    """
+    def write(f):
+        f.write("[")
+        for i, item in enumerate(items):
+            f.write(",\n" if i else "\n")
+            f.write(json.dumps(item))
+        f.write("\n]\n")
+    write_atomic(path, write)
+
+
+def chunked(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def next_order_id(last_seq):
+    """Return ``(seq, order_id)`` for the order after ``last_seq``.
+
+    IDs follow the wall clock in milliseconds but never repeat or go
+    backwards, even when checkouts land in the same millisecond.
+    """
+    seq = max(int(time.time() * 1000), last_seq + 1)
+    return seq, f"ORD-{seq}"
+
+
+# Order documents (schema 2) are one header per order with typed lines:
+#   {"schema": 2, "order_id", "date", "status", "total",
+#    "items": [{"product_id", "name", "qty", "unit_price"}, ...]}
+# Schema 1 stored one flat record per cart line with the quantity baked
+# into a string: {"order_id", "item": "Name (xN)", "date", "price", "status"}.
+ORDER_SCHEMA_VERSION = 2
+ORDER_STATUSES = ["Processing", "Shipped", "Delivered"]
+LEGACY_ITEM_RE = re.compile(r"^(.*) \(x(\d+)\)$")
+
+
+def normalize_orders(records, product_ids=None):
+    """Return schema 2 orders, upgrading any legacy flat records.
+
+    Legacy lines are grouped by ``order_id``. Their product ID is looked
+    up by exact name in ``product_ids`` (name -> id, or a function of the
+    name), so lines for products renamed since then get ``product_id``
+    None.
+    """
+    lookup = product_ids if callable(product_ids) else \
+        (product_ids or {}).get
+    orders = []
+    legacy = {}
+    for record in records:
+        if record.get("schema", 1) >= 2:
+            orders.append(record)
+            continue
+        match = LEGACY_ITEM_RE.match(record['item'])
+        name, qty = (match.group(1), int(match.group(2))) if match \
+            else (record['item'], 1)
+        price = record['price']
+        order = legacy.get(record['order_id'])
+        if order is None:
+            order = {
+                "schema": ORDER_SCHEMA_VERSION,
+                "order_id": record['order_id'],
+                "date": record['date'],
+                "status": record.get('status', 'Processing'),
+                "total": 0,
+                "items": [],
+            }
+            legacy[record['order_id']] = order
+            orders.append(order)
+        order["items"].append({
+            "product_id": lookup(name),
+            "name": name,
             "qty": qty,
-            "image": product['image']
+            "unit_price": price // qty if price % qty == 0 else price / qty,
         })
-    st.toast(f"Added {qty} {product['name']} to cart!", icon="🛒")
+        order["total"] += price
+    return orders
 
 
-def clear_cart_callback():
-    st.session_state.cart = []
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
 
-def remove_item_callback(index):
-    st.session_state.cart.pop(index)
+def _text(record, field, required=True):
+    value = record.get(field)
+    if not isinstance(value, str):
+        value = "" if value is None else str(value)
+    value = value.strip()
+    if required and not value:
+        raise ValueError(f"missing {field}")
+    return value
 
 
-def clear_chat_callback():
-    st.session_state.chat_history = [
-        {"role": "assistant", "content": "Chat cleared. How can I help?"}]
+def _number(record, field, minimum, integer=False):
+    value = record.get(field)
+    if type(value) is int and value >= minimum:
+        return value
+    try:
+        if isinstance(value, str):
+            value = float(value) if "." in value else int(value)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be a number, not {value!r}")
+    if not math.isfinite(value):
+        raise ValueError(f"{field} must be a finite number, not {value!r}")
+    if integer and value != int(value):
+        raise ValueError(f"{field} must be a whole number, not {value!r}")
+    if value < minimum:
+        raise ValueError(f"{field} must be at least {minimum}")
+    return int(value) if integer or value == int(value) else value
 
 
-def update_qty_callback(key, change):
-    if key in st.session_state:
-        new_val = st.session_state[key] + change
-        if 1 <= new_val <= 10:
-            st.session_state[key] = new_val
+def validate_product(record):
+    """Return a clean product from an imported record.
 
+    Raises ValueError naming the first problem found.
+    """
+    return {
+        "id": _text(record, "id"),
+        "name": _text(record, "name"),
+        "category": _text(record, "category"),
+        "price": _number(record, "price", 0, integer=True),
+        "desc": _text(record, "desc", required=False),
+        "image": _text(record, "image", required=False),
+    }
 
-def cancel_order_callback(order_id):
-    if DataManager.delete_order(order_id):
-        st.toast(f"Order {order_id} Cancelled", icon="🗑️")
-    else:
-        st.error("Failed to cancel order.")
 
-# ==========================================
-# 🖼️ PART 4: POPUPS (Chat & Cart Only)
-# ==========================================
+def validate_order(record):
+    """Return a clean schema 2 order from an imported record.
 
+    ``total`` is optional; when given it must match the lines. Raises
+    ValueError naming the first problem found.
+    """
+    order_id = _text(record, "order_id")
+    date = _text(record, "date")
+    try:
+        if not DATE_RE.match(date):
+            raise ValueError
+        datetime.fromisoformat(date)
+    except ValueError:
+        raise ValueError(f"date must be YYYY-MM-DD, not {date!r}")
+    status = _text(record, "status")
+    if status not in ORDER_STATUSES:
+        raise ValueError(f"unknown status {status!r}")
+    items = record.get("items")
+    if not isinstance(items, list) or not items:
+        raise ValueError("an order needs at least one line in items")
+    lines = []
+    for i, line in enumerate(items, 1):
+        if not isinstance(line, dict):
+            raise ValueError(f"line {i} is not an object")
+        try:
+            lines.append({
+                "product_id": _text(line, "product_id", required=False) or None,
+                "name": _text(line, "name"),
+                "qty": _number(line, "qty", 1, integer=True),
+                "unit_price": _number(line, "unit_price", 0),
+            })
+        except ValueError as e:
+            raise ValueError(f"line {i}: {e}")
+    total = sum(line['qty'] * line['unit_price'] for line in lines)
+    if record.get("total") not in (None, "") and \
+            _number(record, "total", 0) != total:
+        raise ValueError(f"total {record['total']} does not match its lines "
+                         f"({total})")
+    return {
+        "schema": ORDER_SCHEMA_VERSION,
+        "order_id": order_id,
+        "date": date,
+        "status": status,
+        "total": total,
+        "items": lines,
+    }
 
-@st.dialog("🛒 Your Cart", width="medium")
-def open_cart_popup():
-    if not st.session_state.cart:
-        st.info("Your cart is empty. Go add some magic!")
-        return
-    c_head1, c_head2 = st.columns([4, 1])
-    with c_head1:
-        st.write(f"Items: **{len(st.session_state.cart)}**")
-    with c_head2:
-        st.button("🗑️ Empty", on_click=clear_cart_callback,
-                  use_container_width=True)
-    st.divider()
 
-    total_amount = 0
-    for i, item in enumerate(st.session_state.cart):
-        c1, c2, c3, c4 = st.columns([1, 3, 1.5, 0.5])
-        with c1:
-            if os.path.exists(item['image']):
-                st.image(item['image'], width=50)
+def order_items_text(order):
+    return ", ".join(f"{line['name']} (x{line['qty']})"
+                     for line in order['items'])
+
+
+def apply_order_ops(history, ops, cancelled=()):
+    """Return a copy of ``history`` with order operations applied in turn.
+
+    ``ops`` are ``("order", order)`` and ``("cancel", order_id)`` pairs.
+    Orders whose ID is already present, or in ``cancelled`` (IDs of
+    orders cancelled before), are skipped, so replaying a batch that was
+    partly written before is harmless.
+    """
+    order_ids = {o['order_id'] for o in history}
+    history = list(history)
+    for op, value in ops:
+        if op == "order":
+            if value['order_id'] not in order_ids and \
+                    value['order_id'] not in cancelled:
+                order_ids.add(value['order_id'])
+                history.append(value)
+        elif value in order_ids:
+            order_ids.discard(value)
+            history = [o for o in history if o['order_id'] != value]
+    return history
+
+
+class DataStore:
+    """Process-wide cache of parsed JSON files.
+
+    Entries are keyed on the file's (mtime, size) signature, so a file edited
+    by hand or by another worker is picked up on the next read. Writers call
+    ``invalidate`` after saving. Cached objects are shared between sessions
+    and must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._run = threading.local()
+        self.loads = 0
+        self.hits = 0
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def read_json(path, default):
+        """Parse a JSON file, bypassing the cache."""
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            get_profiler().count_read(len(raw))
+            return json.loads(raw)
+        except Exception:
+            return default
+
+    def read(self, path, default):
+        sig = self._signature(path)
+        self._count("reads")
+        if sig is None:
+            return default
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == sig:
+                self.hits += 1
+                return entry[1]
+        data = self.read_json(path, default)
+        with self._lock:
+            self._entries[path] = (sig, data)
+            self.loads += 1
+        self._count("loads")
+        return data
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
             else:
-                st.write("📷")
-        with c2:
-            st.markdown(f"**{item['name']}**")
-            st.caption(f"x {item['qty']}")
-        with c3:
-            line_total = item['price'] * item['qty']
-            total_amount += line_total
-            st.write(f"LKR {line_total}")
-        with c4:
-            st.button("❌", key=f"del_{i}",
-                      on_click=remove_item_callback, args=(i,))
-        st.divider()
+                self._entries.pop(path, None)
 
-    col_total, col_checkout = st.columns([2, 1])
-    with col_total:
-        st.markdown(f"### Total: LKR {total_amount}")
-    with col_checkout:
-        if st.button("✅ Checkout", type="primary", use_container_width=True):
-            if DataManager.save_order(st.session_state.cart):
-                st.session_state.cart = []
-                st.balloons()
-                st.success("Order Placed!")
-                time.sleep(1.5)
-                st.rerun()
+    def _count(self, name):
+        setattr(self._run, name, getattr(self._run, name, 0) + 1)
 
+    def begin_run(self):
+        """Reset the per-rerun counters of the calling script thread."""
+        self._run.reads = 0
+        self._run.loads = 0
 
-@st.dialog("✨ Chat with Aura", width="small")
-def open_chat_popup():
-    c1, c2 = st.columns([4, 1])
-    with c1:
-        st.caption("Ask about products...")
-    with c2:
-        st.button("🗑️ Clear", help="Clear", on_click=clear_chat_callback)
+    def metrics(self):
+        reads = self.loads + self.hits
+        return {
+            "run_reads": getattr(self._run, "reads", 0),
+            "run_loads": getattr(self._run, "loads", 0),
+            "total_loads": self.loads,
+            "total_hits": self.hits,
+            "hit_rate": self.hits / reads if reads else 0.0,
+        }
 
-    chat_container = st.container(height=350)
-    for msg in st.session_state.chat_history:
-        avatar = "🔮" if msg["role"] == "assistant" else "👤"
-        with chat_container.chat_message(msg["role"], avatar=avatar):
-            st.write(msg["content"])
 
-    if prompt := st.chat_input("Ask Aura..."):
-        st.session_state.chat_history.append(
-            {"role": "user", "content": prompt})
-        with chat_container.chat_message("user", avatar="👤"):
-            st.write(prompt)
+@st.cache_resource
+def get_data_store():
+    return DataStore()
 
-        with chat_container.chat_message("assistant", avatar="🔮"):
-            with st.spinner("..."):
-                # Prepare context string from history
-                history_str = "\n".join(
-                    [f"{m['role']}: {m['content']}" for m in st.session_state.chat_history[-5:]])
-                reply = get_ai_response(prompt, history_str)
 
-                # --- NEW: CHECK FOR JSON COMMAND ---
+class OrderJournal:
+    """Append-only order log on top of a JSON snapshot.
+
+    Each checkout or cancellation is one JSON line in the journal; a batch
+    of them is written with one fsync.
+    Reads start from the snapshot and replay only the bytes appended since
+    the previous read. ``compact`` folds the journal back into the snapshot.
+    Replay skips orders already present in the snapshot, so a reader that
+    races a compaction never sees an order twice. Writers and compaction
+    hold ``lock`` (a FileLock) so other processes cannot interleave.
+    ``normalize`` upgrades legacy records (see normalize_orders).
+    """
+
+    def __init__(self, snapshot_path, journal_path, compact_every, lock,
+                 normalize):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self.lock = lock
+        self.normalize = normalize
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._offset = 0
+        self._history = []
+        self._order_ids = set()
+        self._pending = 0
+
+    def read(self):
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        while True:
+            signature = DataStore._signature(self.snapshot_path)
+            snapshot = get_data_store().read(self.snapshot_path, [])
+            try:
+                journal_size = os.path.getsize(self.journal_path)
+            except OSError:
+                journal_size = 0
+            if snapshot is not self._snapshot or journal_size < self._offset:
+                self._snapshot = snapshot
+                self._offset = 0
+                self._history = self.normalize(snapshot)
+                self._order_ids = {o['order_id'] for o in self._history}
+                self._pending = 0
+            chunk = b""
+            if journal_size > self._offset:
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(self._offset)
+                    chunk = f.read(journal_size - self._offset)
+                get_profiler().count_read(len(chunk))
+            # Another process compacted while we read: start over.
+            if DataStore._signature(self.snapshot_path) == signature:
+                break
+        # Only replay complete lines; a torn tail is picked up next time.
+        end = chunk.rfind(b"\n") + 1
+        if end:
+            self._apply(chunk[:end].decode("utf-8").splitlines())
+            self._offset += end
+        return self._history
+
+    def _apply(self, lines):
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            self._pending += 1
+            if entry["op"] == "order":
+                if entry["order_id"] in self._order_ids:
+                    continue
+                self._order_ids.add(entry["order_id"])
+                # Appending in place keeps checkout O(1); readers holding
+                # the list only ever see it grow. Journals written before
+                # schema 2 carry flat "records" instead of an "order".
+                if "order" in entry:
+                    self._history.append(entry["order"])
+                else:
+                    self._history.extend(self.normalize(entry["records"]))
+            elif entry["op"] == "cancel":
+                self._order_ids.discard(entry["order_id"])
+                self._history = [o for o in self._history
+                                 if o['order_id'] != entry["order_id"]]
+
+    def append(self, entries):
+        """Append entries to the journal with a single fsync."""
+        with self.lock, self._lock:
+            with open(self.journal_path, 'a') as f:
+                f.write("".join(json.dumps(e) + "\n" for e in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            self._after_write()
+
+    def _after_write(self):
+        self._refresh()
+        if self.compact_every and self._pending >= self.compact_every:
+            self._compact()
+
+    def compact(self):
+        with self.lock, self._lock:
+            self._refresh()
+            if self._pending:
+                self._compact()
+
+    def _compact(self):
+        write_json_atomic(self.snapshot_path, self._history)
+        with open(self.journal_path, 'w'):
+            pass
+        get_data_store().invalidate(self.snapshot_path)
+        self._refresh()
+
+
+class OrderIndex:
+    """Status/date index over an order list for filtered, paged queries.
+
+    Orders are bucketed by date, then status, as positions in the list.
+    A query walks the matching dates newest first and only reads the
+    orders on the requested page, so its cost depends on the number of
+    distinct dates rather than the number of orders. The index is rebuilt
+    when the list changes, or extended when it only grew in place (the
+    journal backend).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.history = None
+        self.length = 0
+        self.buckets = {}
+        self.dates = []
+
+    def sync(self, history):
+        if history is not self.history or len(history) < self.length:
+            self.history = history
+            self.length = 0
+            self.buckets = {}
+            self.dates = []
+        for pos in range(self.length, len(history)):
+            order = history[pos]
+            by_status = self.buckets.get(order['date'])
+            if by_status is None:
+                by_status = self.buckets[order['date']] = {}
+                bisect.insort(self.dates, order['date'])
+            by_status.setdefault(order['status'], []).append(pos)
+        self.length = len(history)
+
+    def query(self, statuses, date_from, date_to, offset, limit):
+        lo = bisect.bisect_left(self.dates, date_from) if date_from else 0
+        hi = bisect.bisect_right(self.dates, date_to) if date_to \
+            else len(self.dates)
+        total = 0
+        page = []
+        for date in reversed(self.dates[lo:hi]):
+            by_status = self.buckets[date]
+            lists = [by_status[s] for s in (statuses or by_status)
+                     if s in by_status]
+            count = sum(len(positions) for positions in lists)
+            total += count
+            if offset >= count:
+                offset -= count
+                continue
+            if limit is not None and len(page) >= limit:
+                continue
+            newest_first = heapq.merge(
+                *[reversed(positions) for positions in lists], reverse=True)
+            for pos in itertools.islice(newest_first, offset, None):
+                if limit is not None and len(page) >= limit:
+                    break
+                page.append(self.history[pos])
+            offset = 0
+        return page, total
+
+
+class StorageBackend:
+    """Base class for DataManager storage.
+
+    Backends must implement ``load_products``, ``load_history``,
+    ``next_order_id`` and ``write_batch``. ``load_history`` returns schema 2
+    orders, oldest first. ``next_order_id`` reserves a unique order ID
+    under the backend's write lock. ``write_batch`` applies order
+    operations (see apply_order_ops) in one write and must be idempotent.
+    The query helpers below work on the loaded lists; backends with real
+    indexes override them.
+    """
+
+    name = "base"
+
+    def load_products(self):
+        raise NotImplementedError
+
+    def load_history(self):
+        raise NotImplementedError
+
+    def next_order_id(self):
+        raise NotImplementedError
+
+    def write_batch(self, ops):
+        raise NotImplementedError
+
+    def append_order(self, order):
+        order_id = self.next_order_id()
+        self.write_batch([("order", {**order, "order_id": order_id})])
+        return order_id
+
+    def cancel_order(self, order_id):
+        self.write_batch([("cancel", order_id)])
+
+    def import_products(self, products):
+        """Add products whose ID is not stored yet; returns how many."""
+        raise NotImplementedError
+
+    def import_orders(self, orders):
+        """Add orders whose ID is not stored yet; returns how many."""
+        raise NotImplementedError
+
+    def export_products(self):
+        return iter(self.load_products())
+
+    def catalog_version(self):
+        """A string that changes whenever the product list does."""
+        return hashlib.sha1(json.dumps(
+            self.load_products(), sort_keys=True).encode()).hexdigest()
+
+    def export_orders(self):
+        return iter(self.load_history())
+
+    def query_orders(self, statuses=None, date_from=None, date_to=None,
+                     offset=0, limit=None):
+        """One page of orders, newest date first, and the match count.
+
+        ``statuses`` is a list of statuses to keep (all when empty);
+        ``date_from``/``date_to`` are inclusive ISO dates.
+        """
+        index = getattr(self, "_order_index", None)
+        if index is None:
+            index = self._order_index = OrderIndex()
+        with index.lock:
+            index.sync(self.load_history())
+            return index.query(statuses, date_from, date_to, offset, limit)
+
+
+class JsonBackend(StorageBackend):
+    """Products and history as plain JSON files, rewritten on each change.
+
+    Legacy records in the history file are upgraded when it is read and
+    written back as schema 2 on the next change.
+    """
+
+    name = "json"
+
+    def __init__(self):
+        self.lock = FileLock(DataManager.LOCK_FILE)
+        # IDs get their own lock so checkouts don't wait on history writes.
+        self.seq_lock = FileLock(DataManager.ORDER_SEQ_LOCK_FILE)
+        self._orders = None
+
+    def next_order_id(self):
+        with self.seq_lock:
+            last_seq = DataStore.read_json(DataManager.ORDER_SEQ_FILE, 0)
+            seq, order_id = next_order_id(last_seq)
+            write_json_atomic(DataManager.ORDER_SEQ_FILE, seq)
+        return order_id
+
+    def _normalize(self, records):
+        # Only legacy records need product IDs. They come from the shared
+        # catalog, so reading the history never loads products.json itself.
+        catalog = []
+
+        def product_id(name):
+            if not catalog:
+                catalog.append(DataManager.catalog())
+            product = catalog[0].by_name.get(normalize_name(name))
+            return product['id'] if product else None
+        return normalize_orders(records, product_id)
+
+    def load_products(self):
+        return get_data_store().read(DataManager.PRODUCT_FILE, [])
+
+    def catalog_version(self):
+        return f"json:{DataStore._signature(DataManager.PRODUCT_FILE)}"
+
+    def load_history(self):
+        records = get_data_store().read(DataManager.HISTORY_FILE, [])
+        cached = self._orders
+        if cached is None or cached[0] is not records:
+            cached = (records, self._normalize(records))
+            self._orders = cached
+        return cached[1]
+
+    def _write_history(self, history):
+        try:
+            write_json_atomic(DataManager.HISTORY_FILE, history)
+        finally:
+            get_data_store().invalidate(DataManager.HISTORY_FILE)
+
+    def _cancelled(self, ops):
+        """IDs of every cancelled order, after saving those in ``ops``.
+
+        Cancelled IDs are kept so that replaying a stale write queue
+        cannot bring back an order the user has since cancelled. Caller
+        holds ``self.lock``.
+        """
+        cancelled = set(DataStore.read_json(DataManager.CANCELLED_FILE, []))
+        fresh = {value for op, value in ops if op == "cancel"} - cancelled
+        if fresh:
+            cancelled |= fresh
+            write_json_atomic(DataManager.CANCELLED_FILE, sorted(cancelled))
+        return cancelled
+
+    def write_batch(self, ops):
+        with self.lock:
+            cancelled = self._cancelled(ops)
+            # Re-read under the lock; the cache may predate another writer.
+            history = self._normalize(
+                DataStore.read_json(DataManager.HISTORY_FILE, []))
+            self._write_history(apply_order_ops(history, ops, cancelled))
+
+    def import_products(self, products):
+        with self.lock:
+            catalog = DataStore.read_json(DataManager.PRODUCT_FILE, [])
+            ids = {p['id'] for p in catalog}
+            added = []
+            for product in products:
+                if product['id'] not in ids:
+                    ids.add(product['id'])
+                    added.append(product)
+            if added:
                 try:
-                    # Simple extraction if the model wraps code
-                    clean_reply = reply.replace(
-                        "```json", "").replace("```", "").strip()
-                    if clean_reply.startswith("{"):
-                        command = json.loads(clean_reply)
-                        if command.get("action") == "add_to_cart":
-                            # Execute Add to Cart
-                            target_name = command.get("item_name")
-                            target_qty = int(command.get("qty", 1))
-
-                            # Find Product Object
-                            products, _ = DataManager.load_data()
-                            product_obj = next(
-                                (p for p in products if p["name"] == target_name), None)
-
-                            if product_obj:
-                                # Add directly to session state cart
-                                found = False
-                                for item in st.session_state.cart:
-                                    if item['id'] == product_obj['id']:
-                                        item['qty'] += target_qty
-                                        found = True
-                                        break
-                                if not found:
-                                    st.session_state.cart.append({
-                                        "id": product_obj['id'],
-                                        "name": product_obj['name'],
-                                        "price": product_obj['price'],
-                                        "qty": target_qty,
-                                        "image": product_obj['image']
-                                    })
-                                success_msg = f"✨ I have added **{target_qty} x {target_name}** to your cart!"
-                                st.write(success_msg)
-                                st.session_state.chat_history.append(
-                                    {"role": "assistant", "content": success_msg})
-                                # Allow UI update
-                                time.sleep(1)
-                                # st.rerun()
-                            else:
-                                err_msg = "I couldn't find that item in the catalog."
-                                st.write(err_msg)
-                                st.session_state.chat_history.append(
-                                    {"role": "assistant", "content": err_msg})
-                        else:
-                            # JSON but not add_to_cart
-                            st.write(reply)
-                            st.session_state.chat_history.append(
-                                {"role": "assistant", "content": reply})
-                    else:
-                        # Normal Text Reply
-                        st.write(reply)
-                        st.session_state.chat_history.append(
-                            {"role": "assistant", "content": reply})
-                except Exception as e:
-                    # Fallback if JSON parsing fails
-                    st.write(reply)
-                    st.session_state.chat_history.append(
-                        {"role": "assistant", "content": reply})
+                    write_json_atomic(DataManager.PRODUCT_FILE,
+                                      catalog + added)
+                finally:
+                    get_data_store().invalidate(DataManager.PRODUCT_FILE)
+            return len(added)
 
+    def import_orders(self, orders):
+        # New orders are streamed straight into the rewritten file; only
+        # the existing history and the set of IDs are held in memory.
+        added = 0
+        with self.lock:
+            history = self._normalize(
+                DataStore.read_json(DataManager.HISTORY_FILE, []))
+            order_ids = {o['order_id'] for o in history}
 
-# ==========================================
-# 🖥️ PART 5: MAIN UI
-# ==========================================
-st.set_page_config(page_title="Dream Spells Store",
-                   page_icon="images/logo/logo.png", layout="wide")
-load_custom_styles()
-
-with st.sidebar:
-    if os.path.exists("images/logo/logo.png"):
-        # Create 3 columns (Spacer | Logo | Spacer) to center it
-        _, col_logo, _ = st.columns([1, 2, 1])
-        with col_logo:
-            st.image("images/logo/logo.png", use_container_width=True)
-    else:
-        st.markdown("## 🧿 Dream Spells")
-        
-    st.divider()
-        
-    st.markdown("""
-        <div class="user-card">
-            <div style="font-size: 3rem;">👤</div>
-            <h3>Ishara Stanley</h3>
-            <p style="color:#aaa;">Premium Member</p>
-        </div>
-    """, unsafe_allow_html=True)
+            def rows():
+                nonlocal added
+                yield from history
+                for order in orders:
+                    if order['order_id'] not in order_ids:
+                        order_ids.add(order['order_id'])
+                        added += 1
+                        yield order
+            try:
+                write_json_array_atomic(DataManager.HISTORY_FILE, rows())
+            finally:
+                get_data_store().invalidate(DataManager.HISTORY_FILE)
+        return added
 
-    st.divider()
-    if st.button("✨ Ask Aura AI", use_container_width=True):
-        open_chat_popup()
-    st.divider()
-    st.info("📍 Shipping to: Kandy, LK")
-
-# --- HEADER & CART BUTTON ---
-c_title, c_cart = st.columns([6, 1.2])
-with c_title:
-    st.title("Dream Spells Collection")
-with c_cart:
-    cart_count = sum(item['qty'] for item in st.session_state.cart)
-    cart_label = f"🛒 Cart ({cart_count})" if cart_count > 0 else "🛒 Cart"
-    if st.button(cart_label, use_container_width=True):
-        open_cart_popup()
-
-st.write("")
-
-# --- TABS FOR SHOP, ORDERS, STATS ---
-tab1, tab2, tab3 = st.tabs(["🛍️ Shop", "📦 Orders", "📊 Spending Stats"])
-
-# === TAB 1: SHOP ===
-with tab1:
-    products, _ = DataManager.load_data()
-    if products:
-        cats = ["All"] + sorted(list(set(p['category'] for p in products)))
-        sel_cat = st.selectbox("Filter:", cats)
-        filtered = products if sel_cat == "All" else [
-            p for p in products if p['category'] == sel_cat]
-        st.write("")
-
-        cols = st.columns(3)
-        for i, p in enumerate(filtered):
-            with cols[i % 3]:
-                with st.container():
-                    if os.path.exists(p.get('image', '')):
-                        st.image(p['image'], use_container_width=True)
-                    else:
-                        st.markdown(
-                            "<div style='height:150px; background:rgba(255,255,255,0.05);'></div>", unsafe_allow_html=True)
 
-                    st.markdown(
-                        f"<span class='category-pill'>{p.get('category')}</span>", unsafe_allow_html=True)
-                    st.subheader(p.get('name'))
-                    st.caption(p.get('desc')[:500] + "...")
-                    st.markdown(
-                        f"<div class='price-tag'>LKR {p.get('price')}</div>", unsafe_allow_html=True)
-
-                    c_qty, c_add = st.columns([1.5, 1.5])
-                    qty_key = f"qty_{p['id']}"
-                    if qty_key not in st.session_state:
-                        st.session_state[qty_key] = 1
-
-                    with c_qty:
-                        b_minus, b_val, b_plus = st.columns(
-                            [1, 1, 1], gap="small")
-                        with b_minus:
-                            st.button(
-                                "➖", key=f"dec_{p['id']}", on_click=update_qty_callback, args=(qty_key, -1))
-                        with b_val:
-                            st.markdown(
-                                f"<div class='qty-display'>{st.session_state[qty_key]}</div>", unsafe_allow_html=True)
-                        with b_plus:
-                            st.button(
-                                "➕", key=f"inc_{p['id']}", on_click=update_qty_callback, args=(qty_key, 1))
-
-                    with c_add:
-                        st.button("Add to Cart", key=f"btn_{p['id']}", on_click=add_to_cart_callback, args=(
-                            p, qty_key), use_container_width=True)
-    else:
-        st.error("Catalog not loaded.")
+class JournalBackend(JsonBackend):
+    """JSON catalog plus an append-only order journal (see OrderJournal)."""
 
-# === TAB 2: ORDERS (Proper Table Layout & Logic) ===
-with tab2:
-    st.subheader("Order History")
-    _, history = DataManager.load_data()
+    name = "journal"
 
-    if history:
-        cols = st.columns([1.5, 2.5, 1.5, 1.5, 1.5, 1])
-        headers = ["Ref ID", "Items", "Date", "Price", "Status", "Action"]
-        for col, h in zip(cols, headers):
-            col.markdown(
-                f"<div style='font-weight:bold; color:#d1c4e9;'>{h}</div>", unsafe_allow_html=True)
-
-        st.markdown(
-            "<hr style='margin:5px 0; border-color:rgba(255,255,255,0.2);'>", unsafe_allow_html=True)
-
-        for order in reversed(history):
-            c1, c2, c3, c4, c5, c6 = st.columns([1.5, 2.5, 1.5, 1.5, 1.5, 1])
-
-            status = order.get('status', 'Processing')
-            status_color = "#FFA726"  # Orange
-            can_cancel = False
-
-            if status == "Shipped":
-                status_color = "#29B6F6"
-            elif status == "Delivered":
-                status_color = "#66BB6A"
-            elif status == "Processing":
-                can_cancel = True
-
-            with c1:
-                st.write(order['order_id'])
-            with c2:
-                st.write(order['item'])
-            with c3:
-                st.write(order['date'])
-            with c4:
-                st.write(f"LKR {order['price']}")
-            with c5:
-                st.markdown(
-                    f"<span style='color:{status_color}; font-weight:bold;'>{status}</span>", unsafe_allow_html=True)
+    def __init__(self):
+        super().__init__()
+        self.journal = OrderJournal(DataManager.HISTORY_FILE,
+                                    DataManager.HISTORY_JOURNAL,
+                                    JOURNAL_COMPACT_EVERY, self.lock,
+                                    self._normalize)
 
-            with c6:
-                if can_cancel:
-                    st.button("Cancel", key=f"cancel_{order['order_id']}", help="Cancel Order", on_click=cancel_order_callback, args=(
-                        order['order_id'],))
-                elif status == "Delivered":
-                    st.write("✅")
-                elif status == "Shipped":
-                    st.write("🚚")
-                else:
-                    st.write("-")
+    def load_history(self):
+        return self.journal.read()
 
-            st.markdown(
-                "<div style='border-bottom:1px solid rgba(255,255,255,0.05); margin-bottom:5px;'></div>", unsafe_allow_html=True)
-    else:
-        st.info("No orders placed yet.")
+    def import_orders(self, orders):
+        # Fold the journal into the snapshot first, then rewrite it once.
+        with self.lock:
+            self.journal.compact()
+            return super().import_orders(orders)
 
-# === TAB 3: STATS (Personal Spending) ===
-with tab3:
-    st.subheader("My Spending Habits")
-    _, history = DataManager.load_data()
+    def write_batch(self, ops):
+        # Replay skips orders already in the history (see OrderJournal);
+        # cancelled ones are dropped here, as compaction forgets them.
+        with self.lock:
+            cancelled = self._cancelled(ops)
+            self.journal.append([
+                {"op": "order", "order_id": value['order_id'], "order": value}
+                if op == "order" else {"op": "cancel", "order_id": value}
+                for op, value in ops
+                if op != "order" or value['order_id'] not in cancelled])
 
-    if history:
-        df_hist = pd.DataFrame(history)
-        df_hist['price'] = pd.to_numeric(df_hist['price'])
 
-        total_spent = df_hist['price'].sum()
-        total_orders = len(df_hist)
+class SQLiteBackend(StorageBackend):
+    """Products and orders in a local SQLite database in WAL mode.
 
-        c1, c2 = st.columns(2)
-        c1.metric("Total Spent (LKR)", f"{total_spent:,}")
-        c2.metric("Total Orders Placed", total_orders)
+    WAL lets several Streamlit worker processes read while one writes. On
+    first open the existing JSON files are migrated once, and databases
+    created with the flat schema 1 ``orders`` table are upgraded. Every
+    write bumps a version counter in the ``meta`` table, so full-list reads
+    are cached until any process changes the data.
+    """
 
-        st.divider()
+    name = "sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS products (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            "desc" TEXT NOT NULL DEFAULT '',
+            image TEXT NOT NULL DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL UNIQUE,
+            date TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total NUMERIC NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cancelled_orders (
+            order_id TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            product_id TEXT,
+            name TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            unit_price NUMERIC NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_products_category ON products(category);
+        CREATE INDEX IF NOT EXISTS idx_orders_date ON orders(date);
+        CREATE INDEX IF NOT EXISTS idx_orders_status_date
+            ON orders(status, date);
+        CREATE INDEX IF NOT EXISTS idx_order_items_order_id
+            ON order_items(order_id);
+        CREATE INDEX IF NOT EXISTS idx_order_items_product_id
+            ON order_items(product_id);
+    """
+    PRODUCT_COLUMNS = 'id, name, category, price, "desc", image'
+    ORDER_COLUMNS = "order_id, date, status, total"
+    ITEM_COLUMNS = "order_id, product_id, name, qty, unit_price"
 
-        st.caption("📅 Spending Timeline")
-        if 'date' in df_hist.columns:
-            spending_trend = df_hist.groupby('date')['price'].sum()
-            st.line_chart(spending_trend, color="#00e676")
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        self._write(self._create_schema)
+        self._migrate_from_json()
+
+    def _conn(self):
+        # sqlite3 connections cannot be shared between script threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, fn, *bumps):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            self._bump(conn, *bumps)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _bump(conn, *keys):
+        for key in keys:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + 1", (key,))
+
+    def _read(self, fn):
+        # One read transaction, so multi-statement reads see one snapshot.
+        conn = self._conn()
+        with get_profiler().span("sqlite.read"):
+            conn.execute("BEGIN")
+            try:
+                return fn(conn)
+            finally:
+                conn.execute("COMMIT")
+
+    def _create_schema(self, conn):
+        # Schema 1 kept one flat row per cart line in "orders".
+        columns = [r[1] for r in conn.execute("PRAGMA table_info(orders)")]
+        legacy = []
+        if "item" in columns:
+            legacy = [dict(r) for r in conn.execute(
+                "SELECT order_id, item, date, price, status FROM orders "
+                "ORDER BY id")]
+            conn.execute("DROP TABLE orders")
+        for statement in self.SCHEMA.split(";"):
+            if statement.strip():
+                conn.execute(statement)
+        if legacy:
+            product_ids = {r[0]: r[1] for r in conn.execute(
+                "SELECT name, id FROM products")}
+            self._insert_orders(conn, normalize_orders(legacy, product_ids))
+            self._bump(conn, "history_version")
+
+    def _insert_orders(self, conn, orders):
+        conn.executemany(
+            f"INSERT INTO orders ({self.ORDER_COLUMNS}) VALUES (?, ?, ?, ?)",
+            [(o['order_id'], o['date'], o['status'], o['total'])
+             for o in orders])
+        conn.executemany(
+            f"INSERT INTO order_items ({self.ITEM_COLUMNS}) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(o['order_id'], line['product_id'], line['name'], line['qty'],
+              line['unit_price']) for o in orders for line in o['items']])
+
+    def _migrate_from_json(self):
+        def migrate(conn):
+            done = conn.execute(
+                "SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+            if done:
+                return
+            products = DataStore.read_json(DataManager.PRODUCT_FILE, [])
+            history = DataStore.read_json(DataManager.HISTORY_FILE, [])
+            conn.executemany(
+                f"INSERT OR IGNORE INTO products ({self.PRODUCT_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(p['id'], p['name'], p['category'], p['price'],
+                  p.get('desc', ''), p.get('image', '')) for p in products])
+            self._insert_orders(conn, normalize_orders(
+                history, {p['name']: p['id'] for p in products}))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated', 1)")
+            if products or history:
+                self._bump(conn, "catalog_version", "history_version")
+        # Versions only move when rows were imported, so reopening a
+        # migrated database leaves other workers' caches valid.
+        self._write(migrate)
+
+    def _version(self, key):
+        # fetchall() finishes the statement; a half-read cursor would pin
+        # this connection to an old WAL snapshot.
+        rows = self._conn().execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchall()
+        return rows[0][0] if rows else 0
+
+    def _cached(self, key, load):
+        def read(conn):
+            version = self._version(key)
+            with self._cache_lock:
+                entry = self._cache.get(key)
+                if entry is not None and entry[0] == version:
+                    return entry[1]
+            rows = load(conn)
+            with self._cache_lock:
+                self._cache[key] = (version, rows)
+            return rows
+        return self._read(read)
+
+    def _orders_with_items(self, headers):
+        orders = {}
+        for r in headers:
+            orders[r['order_id']] = {"schema": ORDER_SCHEMA_VERSION,
+                                     **dict(r), "items": []}
+        return orders
+
+    def _fill_items(self, orders, items):
+        for r in items:
+            line = dict(r)
+            orders[line.pop('order_id')]['items'].append(line)
+        return list(orders.values())
+
+    def _load_orders(self, conn):
+        orders = self._orders_with_items(conn.execute(
+            f"SELECT {self.ORDER_COLUMNS} FROM orders ORDER BY id"))
+        return self._fill_items(orders, conn.execute(
+            f"SELECT {self.ITEM_COLUMNS} FROM order_items ORDER BY id"))
+
+    def load_products(self):
+        return self._cached("catalog_version", lambda conn: [
+            dict(r) for r in conn.execute(
+                f"SELECT {self.PRODUCT_COLUMNS} FROM products "
+                "ORDER BY rowid")])
+
+    def load_history(self):
+        return self._cached("history_version", self._load_orders)
+
+    def catalog_version(self):
+        return f"sqlite:{self._read(lambda conn: self._version('catalog_version'))}"
+
+    def next_order_id(self):
+        def allocate(conn):
+            # BEGIN IMMEDIATE in _write serializes ID allocation.
+            seq, order_id = next_order_id(self._version("order_seq"))
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('order_seq', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (seq,))
+            return order_id
+        return self._write(allocate)
+
+    def write_batch(self, ops):
+        def write(conn):
+            for op, value in ops:
+                # Cancelled IDs are kept, so replaying a stale write
+                # queue cannot bring back a cancelled order.
+                if op == "order":
+                    if not conn.execute(
+                            "SELECT 1 FROM orders WHERE order_id = ? UNION ALL "
+                            "SELECT 1 FROM cancelled_orders WHERE order_id = ?",
+                            (value['order_id'], value['order_id'])).fetchall():
+                        self._insert_orders(conn, [value])
+                else:
+                    conn.execute("INSERT OR IGNORE INTO cancelled_orders "
+                                 "(order_id) VALUES (?)", (value,))
+                    conn.execute("DELETE FROM order_items WHERE order_id = ?",
+                                 (value,))
+                    conn.execute("DELETE FROM orders WHERE order_id = ?",
+                                 (value,))
+        self._write(write, "history_version")
+
+    # Rows per import transaction, and per query when reading in bulk
+    # (under SQLite's limit on bound parameters).
+    BULK_CHUNK = 5000
+    BULK_QUERY = 500
+
+    def import_products(self, products):
+        def insert(conn, chunk):
+            return conn.executemany(
+                f"INSERT OR IGNORE INTO products ({self.PRODUCT_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(p['id'], p['name'], p['category'], p['price'], p['desc'],
+                  p['image']) for p in chunk]).rowcount
+        return sum(self._write(lambda conn: insert(conn, chunk),
+                               "catalog_version")
+                   for chunk in chunked(products, self.BULK_CHUNK))
+
+    def import_orders(self, orders):
+        def insert(conn, chunk):
+            seen = set()
+            for part in chunked([o['order_id'] for o in chunk],
+                                self.BULK_QUERY):
+                seen.update(r[0] for r in conn.execute(
+                    "SELECT order_id FROM orders WHERE order_id IN "
+                    f"({', '.join('?' * len(part))})", part))
+            fresh = []
+            for order in chunk:
+                if order['order_id'] not in seen:
+                    seen.add(order['order_id'])
+                    fresh.append(order)
+            self._insert_orders(conn, fresh)
+            return len(fresh)
+        return sum(self._write(lambda conn: insert(conn, chunk),
+                               "history_version")
+                   for chunk in chunked(orders, self.BULK_CHUNK))
+
+    def _export(self, sql, fill=None):
+        # A connection of its own, so one read transaction (one snapshot)
+        # can stay open while the caller consumes the rows.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN")
+            rows = conn.execute(sql)
+            while True:
+                chunk = rows.fetchmany(self.BULK_QUERY)
+                if not chunk:
+                    break
+                yield from fill(conn, chunk) if fill else map(dict, chunk)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def export_products(self):
+        return self._export(
+            f"SELECT {self.PRODUCT_COLUMNS} FROM products ORDER BY rowid")
+
+    def export_orders(self):
+        def fill(conn, headers):
+            orders = self._orders_with_items(headers)
+            marks = ", ".join("?" * len(orders))
+            return self._fill_items(orders, conn.execute(
+                f"SELECT {self.ITEM_COLUMNS} FROM order_items "
+                f"WHERE order_id IN ({marks}) ORDER BY id", list(orders)))
+        return self._export(
+            f"SELECT {self.ORDER_COLUMNS} FROM orders ORDER BY id", fill)
+
+    def query_orders(self, statuses=None, date_from=None, date_to=None,
+                     offset=0, limit=None):
+        where = []
+        params = []
+        if statuses:
+            where.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params += statuses
+        if date_from:
+            where.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("date <= ?")
+            params.append(date_to)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+
+        def read(conn):
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM orders {clause}", params).fetchall()[0][0]
+            orders = self._orders_with_items(conn.execute(
+                f"SELECT {self.ORDER_COLUMNS} FROM orders {clause} "
+                "ORDER BY date DESC, id DESC LIMIT ? OFFSET ?",
+                params + [-1 if limit is None else limit, offset]))
+            if not orders:
+                return [], total
+            marks = ", ".join("?" * len(orders))
+            return self._fill_items(orders, conn.execute(
+                f"SELECT {self.ITEM_COLUMNS} FROM order_items "
+                f"WHERE order_id IN ({marks}) ORDER BY id",
+                list(orders))), total
+        return self._read(read)
+
+
+class SpendingStats:
+    """Materialized spending aggregates for the Stats tab.
+
+    Holds the total, order count, per-day and per-product sums, plus each
+    order so a cancellation can be subtracted in O(1). Product sums are
+    keyed by product ID (or line name when the ID is unknown) and joined
+    to current catalog names on read, so renamed products stay together.
+    ``history`` and ``length`` record which history list the numbers
+    describe; any other list means they must be rebuilt.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._catalog = None
+        self._names = {}
+        self.reset(None)
+
+    def reset(self, history):
+        self.history = history
+        self.length = len(history) if history is not None else 0
+        self.total = 0
+        self.count = 0
+        self.by_date = {}
+        self.by_product = {}
+        self.by_order = {}
+        # Stop at the measured length: the journal backend appends to its
+        # list in place, and later orders belong to incremental updates.
+        for order in itertools.islice(history or (), self.length):
+            self._add(order)
+
+    def describes(self, history, length=None):
+        length = len(history) if length is None else length
+        return history is self.history and length == self.length
+
+    def product_names(self, products):
+        if products is not self._catalog:
+            self._catalog = products
+            self._names = {p['id']: p['name'] for p in products}
+        return self._names
+
+    @staticmethod
+    def _bump_key(table, key, amount):
+        value = table.get(key, 0) + amount
+        if value:
+            table[key] = value
+        else:
+            table.pop(key, None)
+
+    def _bump(self, order, sign):
+        self.total += order['total'] * sign
+        self.count += sign
+        self._bump_key(self.by_date, order['date'], order['total'] * sign)
+        for line in order['items']:
+            self._bump_key(self.by_product, line['product_id'] or line['name'],
+                           line['qty'] * line['unit_price'] * sign)
+
+    def _add(self, order):
+        self._bump(order, 1)
+        self.by_order[order['order_id']] = order
+
+    def add_order(self, order):
+        self._add(order)
+        self.length += 1
+
+    def remove_order(self, order_id):
+        order = self.by_order.pop(order_id, None)
+        if order is not None:
+            self._bump(order, -1)
+            self.length -= 1
+
+
+@st.cache_resource
+def get_spending_stats():
+    return SpendingStats()
+
+
+STORAGE_BACKENDS = {
+    "json": JsonBackend,
+    "journal": JournalBackend,
+    "sqlite": lambda: SQLiteBackend(DataManager.DB_FILE),
+}
+
+
+@st.cache_resource
+def get_storage():
+    if STORAGE_MODE not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown STORAGE_MODE: {STORAGE_MODE!r}")
+    return STORAGE_BACKENDS[STORAGE_MODE]()
+
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are can do does for have how i in is it me my of on or "
+    "show the this that to what which with you your".split())
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(str(text).lower())
+            if t not in STOPWORDS]
+
+
+def normalize_name(name):
+    """Product name without case or punctuation: "Love's Embrace" -> "love s embrace"."""
+    return " ".join(TOKEN_RE.findall(str(name).lower()))
+
+
+class Catalog:
+    """Lookup indexes over one version of the product list.
+
+    - ``by_id`` and ``by_name`` (normalized names) for exact lookups
+    - ``by_category`` and ``categories`` for the Shop filter
+    - a BM25 inverted index over name, category and description for
+      ``search`` (the Shop search box and Aura's prompt context)
+    - ``resolve_name`` for the loose names Aura's commands use
+    """
+
+    FIELD_WEIGHTS = (("name", 3), ("category", 2), ("desc", 1))
+    K1 = 1.5
+    B = 0.75
+    # Minimum similarity for a fuzzy name match, and how clearly it must
+    # beat the runner-up to count.
+    NAME_CUTOFF = 0.6
+    NAME_MARGIN = 0.05
+
+    def __init__(self, products):
+        self.products = products
+        self.by_id = {}
+        self.by_name = {}
+        self.by_category = {}
+        self.names = []
+        self.name_postings = {}
+        self.postings = {}
+        self.lengths = []
+        for i, p in enumerate(products):
+            self.by_id[p['id']] = p
+            name = normalize_name(p.get('name', ""))
+            self.names.append(name)
+            self.by_name.setdefault(name, p)
+            for token in set(name.split()):
+                self.name_postings.setdefault(token, []).append(i)
+            self.by_category.setdefault(p.get('category'), []).append(p)
+            counts = {}
+            for field, weight in self.FIELD_WEIGHTS:
+                for token in tokenize(p.get(field, "")):
+                    counts[token] = counts.get(token, 0) + weight
+            self.lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings.setdefault(token, []).append((i, tf))
+        self.categories = sorted(self.by_category)
+        self.category_counts = {c: len(ps) for c, ps in self.by_category.items()}
+        self.avg_length = (sum(self.lengths) / len(self.lengths)
+                           if self.lengths else 1)
+        self.fingerprint = hashlib.sha1(
+            json.dumps(products, sort_keys=True).encode()).hexdigest()
+
+    def search(self, query, k):
+        """Up to ``k`` products best matching ``query``, best first."""
+        n = len(self.products)
+        scores = {}
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) /
+                           (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = tf + self.K1 * (1 - self.B + self.B *
+                                       self.lengths[i] / self.avg_length)
+                scores[i] = scores.get(i, 0) + idf * tf * (self.K1 + 1) / norm
+        top = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+        return [self.products[i] for i, _ in top]
+
+    def resolve_name(self, name):
+        """The product ``name`` most likely refers to, or None.
+
+        Exact (normalized) names win. Next, a product whose every name
+        word appears in ``name`` ("Radiance of the Sun & Flame" finds
+        "Sun & Flame"), the wordiest one if several do, then the only
+        product whose name holds every word of ``name`` ("Glow" finds
+        "Radiant Glow"). Otherwise products
+        sharing a word with ``name`` are ranked by string similarity, so
+        "Legendary Heroes" finds "Legendary Heroes Unite"; a name with no
+        word in common falls back to comparing against every name.
+        """
+        key = normalize_name(name)
+        if not key:
+            return None
+        if key in self.by_name:
+            return self.by_name[key]
+        tokens = set(key.split())
+        candidates = {i for token in tokens
+                      for i in self.name_postings.get(token, ())}
+        contained = sorted(
+            ((len(set(self.names[i].split())), i) for i in candidates
+             if set(self.names[i].split()) <= tokens), reverse=True)
+        if contained and (len(contained) == 1 or
+                          contained[0][0] > contained[1][0]):
+            return self.products[contained[0][1]]
+        covering = [i for i in candidates
+                    if tokens <= set(self.names[i].split())]
+        if len(covering) == 1:
+            return self.products[covering[0]]
+        if not candidates:
+            candidates = range(len(self.names))
+        scored = sorted(
+            ((difflib.SequenceMatcher(None, key, self.names[i]).ratio(), i)
+             for i in candidates), reverse=True)
+        if not scored or scored[0][0] < self.NAME_CUTOFF:
+            return None
+        if len(scored) > 1 and scored[0][0] - scored[1][0] < self.NAME_MARGIN:
+            return None
+        return self.products[scored[0][1]]
+
+
+@st.cache_resource
+def get_catalog_cache():
+    return {}
+
+
+def get_catalog(products):
+    """Return the catalog indexes for this exact product list, building
+    them once.
+
+    Storage backends hand out the same list object until the catalog
+    changes, so identity is a cheap version check.
+    """
+    cache = get_catalog_cache()
+    entry = cache.get("catalog")
+    if entry is None or entry[0] is not products:
+        build = SnapshotCatalog if isinstance(products, SnapshotProducts) \
+            else Catalog
+        entry = (products, build(products))
+        cache["catalog"] = entry
+    return entry[1]
+
+
+def _bisect_left(n, key_at, target):
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(mid) < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def compile_catalog_snapshot(products, path, source):
+    """Write ``products`` and their Catalog indexes to a snapshot file.
+
+    Layout: magic, a little-endian u32 header length, a JSON header, then
+    8-byte aligned sections in native byte order. Each text column is an
+    offsets array plus a UTF-8 blob. Alongside the columns are the
+    positions sorted by ID and by normalized name, positions grouped by
+    category, the BM25 postings and the name word postings. ``source`` is
+    the storage's catalog_version. The file is replaced atomically.
+    """
+    catalog = Catalog(products)
+    n = len(products)
+    sections = {}
+    chunks = []
+    size = 0
+
+    def add(name, typecode, data):
+        nonlocal size
+        raw = data.tobytes() if isinstance(data, array) else data
+        sections[name] = [size, len(raw), typecode]
+        chunks.append(raw + b"\0" * (-len(raw) % 8))
+        size += len(raw) + (-len(raw) % 8)
+
+    def add_strings(name, values):
+        blobs = [str(v).encode("utf-8") for v in values]
+        offsets = array('I', [0])
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        add(name + ".offsets", 'I', offsets)
+        add(name, 'B', b"".join(blobs))
+
+    def add_postings(name, postings, width):
+        terms = sorted(postings)
+        offsets = array('I', [0])
+        flat = array('I')
+        for term in terms:
+            for entry in postings[term]:
+                flat.extend(entry if width == 2 else (entry,))
+            offsets.append(len(flat) // width)
+        add_strings(name + ".terms", terms)
+        add(name + ".term_offsets", 'I', offsets)
+        add(name, 'I', flat)
+
+    for field in SnapshotProducts.FIELDS:
+        if field != "price":
+            add_strings(field, (p.get(field) or "" for p in products))
+    prices = [p['price'] for p in products]
+    price_type = 'q' if all(isinstance(x, int) for x in prices) else 'd'
+    add("price", price_type, array(price_type, prices))
+    add_strings("names", catalog.names)
+    add("lengths", 'I', array('I', catalog.lengths))
+    add("id_order", 'I', array('I', sorted(range(n),
+                                           key=lambda i: products[i]['id'])))
+    add("name_order", 'I', array('I', sorted(
+        range(n), key=lambda i: (catalog.names[i], i))))
+    by_category = {}
+    for i, p in enumerate(products):
+        by_category.setdefault(p.get('category'), []).append(i)
+    categories = []
+    positions = array('I')
+    for category in catalog.categories:
+        categories.append([category, len(positions),
+                           len(by_category[category])])
+        positions.extend(by_category[category])
+    add("category_positions", 'I', positions)
+    add_postings("postings", catalog.postings, 2)
+    add_postings("name_postings", catalog.name_postings, 1)
+
+    header = json.dumps({
+        "source": source,
+        "fingerprint": catalog.fingerprint,
+        "byteorder": sys.byteorder,
+        "count": n,
+        "avg_length": catalog.avg_length,
+        "categories": categories,
+        "sections": sections,
+    }).encode("utf-8")
+    prefix = CatalogSnapshot.MAGIC + struct.pack("<I", len(header)) + header
+
+    def write(f):
+        f.write(prefix + b"\0" * (-len(prefix) % 8))
+        for chunk in chunks:
+            f.write(chunk)
+    # Readable by workers running as other users.
+    write_atomic(path, write, binary=True, permissions=0o644)
+
+
+class CatalogSnapshot:
+    """A compiled catalog file (see compile_catalog_snapshot), mapped
+    read-only.
+
+    Sections are memoryviews straight into the mapping, so every worker
+    process shares one copy through the OS page cache and nothing is
+    parsed up front. The mapping stays valid after the file is replaced;
+    it is released once nothing refers to this snapshot.
+    """
+
+    MAGIC = b"DSCATLG1"
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._mmap[:8] != self.MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        (length,) = struct.unpack_from("<I", self._mmap, 8)
+        self.header = json.loads(self._mmap[12:12 + length])
+        self._base = 12 + length + (-(12 + length) % 8)
+        self._view = memoryview(self._mmap)
+        self.source = self.header["source"] \
+            if self.header["byteorder"] == sys.byteorder else None
+        self.products = SnapshotProducts(self)
+
+    def section(self, name):
+        offset, length, typecode = self.header["sections"][name]
+        view = self._view[self._base + offset:self._base + offset + length]
+        return view if typecode == 'B' else view.cast(typecode)
+
+    def strings(self, name):
+        return SnapshotStrings(self.section(name + ".offsets"),
+                               self.section(name))
+
+
+class SnapshotStrings(Sequence):
+    """A text column: item ``i`` is decoded from the blob on access."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+
+class SnapshotProducts(Sequence):
+    """The snapshot's products as a read-only list of product dicts.
+
+    Dicts are built on access, so callers must not modify or keep them.
+    """
+
+    FIELDS = ("id", "name", "category", "price", "desc", "image")
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._columns = [snapshot.section(f) if f == "price"
+                         else snapshot.strings(f) for f in self.FIELDS]
+        self._count = snapshot.header["count"]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("product index out of range")
+        return {f: column[i] for f, column in zip(self.FIELDS, self._columns)}
+
+
+class SnapshotIndex(Mapping):
+    """Key -> product over a column and positions sorted by that column."""
+
+    def __init__(self, keys, order, products):
+        self.keys = keys
+        self.order = order
+        self.products = products
+
+    def _find(self, key):
+        lo = _bisect_left(len(self.order),
+                          lambda k: self.keys[self.order[k]], key)
+        if lo < len(self.order) and self.keys[self.order[lo]] == key:
+            return self.order[lo]
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos is None:
+            raise KeyError(key)
+        return self.products[pos]
+
+    def __iter__(self):
+        return (self.keys[pos] for pos in self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class SnapshotPostings(Mapping):
+    """Term -> postings list, read from the snapshot on lookup."""
+
+    def __init__(self, snapshot, name, width):
+        self.terms = snapshot.strings(name + ".terms")
+        self.offsets = snapshot.section(name + ".term_offsets")
+        self.flat = snapshot.section(name)
+        self.width = width
+
+    def __getitem__(self, term):
+        i = _bisect_left(len(self.terms), self.terms.__getitem__, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            raise KeyError(term)
+        start, end = self.offsets[i] * self.width, \
+            self.offsets[i + 1] * self.width
+        if self.width == 1:
+            return self.flat[start:end].tolist()
+        return list(zip(self.flat[start:end:2], self.flat[start + 1:end:2]))
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class SnapshotCategories(Mapping):
+    """Category -> products, from the snapshot's grouped positions."""
+
+    def __init__(self, snapshot, products):
+        self.ranges = {c: (start, count) for c, start, count
+                       in snapshot.header["categories"]}
+        self.positions = snapshot.section("category_positions")
+        self.products = products
+
+    def __getitem__(self, category):
+        start, count = self.ranges[category]
+        return [self.products[i]
+                for i in self.positions[start:start + count]]
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+
+class SnapshotCatalog(Catalog):
+    """Catalog whose indexes are read from a mapped CatalogSnapshot
+    instead of being built in this process."""
+
+    def __init__(self, products):
+        snapshot = products.snapshot
+        header = snapshot.header
+        self.products = products
+        self.names = snapshot.strings("names")
+        self.by_id = SnapshotIndex(snapshot.strings("id"),
+                                   snapshot.section("id_order"), products)
+        self.by_name = SnapshotIndex(self.names,
+                                     snapshot.section("name_order"), products)
+        self.by_category = SnapshotCategories(snapshot, products)
+        self.categories = [c for c, _, _ in header["categories"]]
+        self.category_counts = {c: count for c, _, count
+                                in header["categories"]}
+        self.postings = SnapshotPostings(snapshot, "postings", 2)
+        self.name_postings = SnapshotPostings(snapshot, "name_postings", 1)
+        self.lengths = snapshot.section("lengths")
+        self.avg_length = header["avg_length"]
+        self.fingerprint = header["fingerprint"]
+
+
+class CatalogSnapshots:
+    """This process's view of the shared catalog snapshot at ``path``.
+
+    ``products`` returns the mapped snapshot's products, checking at most
+    every ``recheck`` seconds whether storage has a newer catalog. When it
+    does, the file is remapped if another worker already recompiled it,
+    or recompiled here under a file lock. Reruns already holding the old
+    snapshot keep using it, so the swap is atomic for each rerun.
+    """
+
+    def __init__(self, path, recheck):
+        self.path = path
+        self.recheck = recheck
+        self.lock = FileLock(path + ".lock")
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked = 0.0
+        self.compiles = 0
+
+    def _reopen(self, snapshot):
+        # The file as it is on disk now, if it differs from ``snapshot``.
+        signature = DataStore._signature(self.path)
+        if signature is None or (snapshot is not None
+                                 and snapshot.signature == signature):
+            return snapshot
+        try:
+            return CatalogSnapshot(self.path)
+        except (OSError, ValueError, KeyError):
+            return snapshot  # unreadable; recompiled below
+
+    def products(self):
+        snapshot = self._snapshot
+        if snapshot is not None and \
+                time.monotonic() - self._checked < self.recheck:
+            return snapshot.products
+        with self._lock:
+            storage = get_storage()
+            source = storage.catalog_version()
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.source != source:
+                snapshot = self._reopen(snapshot)
+            if snapshot is None or snapshot.source != source:
+                with self.lock:
+                    snapshot = self._reopen(snapshot)
+                    if snapshot is None or snapshot.source != source:
+                        compile_catalog_snapshot(
+                            storage.load_products(), self.path, source)
+                        self.compiles += 1
+                        snapshot = CatalogSnapshot(self.path)
+            self._snapshot = snapshot
+            self._checked = time.monotonic()
+            return snapshot.products
+
+
+@st.cache_resource
+def get_catalog_snapshots():
+    return CatalogSnapshots(CATALOG_SNAPSHOT, CATALOG_RECHECK)
+
+
+class DataManager:
+    PRODUCT_FILE = "products.json"
+    HISTORY_FILE = "purchase_history.json"
+    HISTORY_JOURNAL = "purchase_history.journal"
+    LOCK_FILE = "purchase_history.lock"
+    ORDER_SEQ_FILE = "purchase_history.seq"
+    ORDER_SEQ_LOCK_FILE = "purchase_history.seq.lock"
+    CANCELLED_FILE = "purchase_history.cancelled.json"
+    DB_FILE = get_setting("SQLITE_PATH", "dream_spells.db")
+
+    @staticmethod
+    def load_products():
+        with get_profiler().span("load.products"):
+            if CATALOG_SNAPSHOT:
+                return get_catalog_snapshots().products()
+            return get_storage().load_products()
+
+    @staticmethod
+    def load_history():
+        """Stored orders plus this process's writes still in the queue."""
+        # Pending ops first: one that lands in between is then seen twice
+        # and skipped by apply_order_ops, never missed.
+        ops = get_order_writer().pending_ops()
+        with get_profiler().span("load.history"):
+            history = get_storage().load_history()
+        return apply_order_ops(history, ops) if ops else history
+
+    @staticmethod
+    def load_data():
+        return DataManager.load_products(), DataManager.load_history()
+
+    @staticmethod
+    def catalog():
+        return get_catalog(DataManager.load_products())
+
+    @staticmethod
+    def product(product_id):
+        return DataManager.catalog().by_id.get(product_id)
+
+    @staticmethod
+    def categories():
+        return DataManager.catalog().categories
+
+    @staticmethod
+    def products_in_category(category):
+        return DataManager.catalog().by_category.get(category, [])
+
+    @staticmethod
+    def query_orders(statuses=None, date_from=None, date_to=None,
+                     offset=0, limit=None):
+        if not get_order_writer().pending_ops():
+            return get_storage().query_orders(statuses, date_from, date_to,
+                                              offset, limit)
+        # Writes are in flight: index the overlaid history for this call.
+        index = OrderIndex()
+        index.sync(DataManager.load_history())
+        return index.query(statuses, date_from, date_to, offset, limit)
+
+    @staticmethod
+    def spending_stats():
+        """Current SpendingStats, rebuilt only if history changed elsewhere."""
+        ops = get_order_writer().pending_ops()
+        history = get_storage().load_history()
+        products = DataManager.load_products()
+        if ops:
+            # The shared aggregates describe stored orders only; queued
+            # writes get a one-off copy.
+            stats = SpendingStats()
+            history = apply_order_ops(history, ops)
+        else:
+            stats = get_spending_stats()
+        with stats.lock:
+            if not stats.describes(history):
+                stats.reset(history)
+            return {
+                "total": stats.total,
+                "count": stats.count,
+                "by_date": dict(stats.by_date),
+                "by_product": dict(stats.by_product),
+                "product_names": stats.product_names(products),
+            }
+
+    @staticmethod
+    def _update_stats(before, before_len, apply):
+        # Apply a write to the aggregates only if they described the
+        # history before it and no other writer slipped in; otherwise the
+        # next spending_stats() call rebuilds them. The length is passed
+        # separately because the journal backend grows its list in place.
+        stats = get_spending_stats()
+        after = get_storage().load_history()
+        with stats.lock:
+            if stats.describes(before, before_len):
+                apply(stats)
+                if len(after) == stats.length:
+                    stats.history = after
+                    return
+            stats.history = None
+
+    @staticmethod
+    def save_order(cart_items):
+        current_date = datetime.now().strftime("%Y-%m-%d")
+
+        order = {
+            "schema": ORDER_SCHEMA_VERSION,
+            "date": current_date,
+            "status": "Processing",
+            "total": sum(item['price'] * item['qty'] for item in cart_items),
+            "items": [{
+                "product_id": item['id'],
+                "name": item['name'],
+                "qty": item['qty'],
+                "unit_price": item['price'],
+            } for item in cart_items],
+        }
+
+        try:
+            with get_profiler().span("checkout.write"):
+                order_id = get_storage().next_order_id()
+                get_order_writer().submit(
+                    "order", {**order, "order_id": order_id})
+        except Exception as e:
+            st.error(f"Failed to save: {e}")
+            return False
+        return order_id
+
+    @staticmethod
+    def delete_order(order_id_to_remove):
+        try:
+            with get_profiler().span("cancel.write"):
+                get_order_writer().submit("cancel", order_id_to_remove)
+        except:
+            return False
+        return True
+
+    @staticmethod
+    def import_products(products):
+        """Bulk-add validated products (see validate_product)."""
+        return get_storage().import_products(products)
+
+    @staticmethod
+    def import_orders(orders):
+        """Bulk-add validated orders (see validate_order)."""
+        return get_storage().import_orders(orders)
+
+    @staticmethod
+    def export_products():
+        return get_storage().export_products()
+
+    @staticmethod
+    def export_orders():
+        return get_storage().export_orders()
+
+    @staticmethod
+    def write_orders(ops):
+        """Apply queued order operations to storage and the aggregates."""
+        storage = get_storage()
+        before = storage.load_history()
+        before_len = len(before)
+        storage.write_batch(ops)
+
+        def apply(stats):
+            for op, value in ops:
+                if op == "order":
+                    stats.add_order(value)
+                else:
+                    stats.remove_order(value)
+        DataManager._update_stats(before, before_len, apply)
+
+
+class OrderWriter:
+    """Write-behind queue for checkouts and cancellations.
+
+    ``submit`` appends the operation to this process's spool file, fsyncs
+    it and returns; a background thread then writes queued operations to
+    storage in batches (group commit). It waits up to ``window`` seconds
+    for company once work arrives, writes at most ``batch_max`` operations
+    at a time, and whatever queues up during a write goes in the next
+    batch. Until then ``pending_ops`` lets readers overlay the queued
+    operations on what storage returns, so a session sees its own
+    checkout straight away.
+
+    Each writer holds a lock on its spool while the process lives. At
+    startup, spools that nobody holds (left by a crashed worker) are
+    replayed into storage. After each batch the spool is rewritten to hold
+    only the operations still queued, so it stays as small as the queue
+    and replay covers just the operations that never landed.
+    """
+
+    SPOOL_PREFIX = "purchase_history."
+    SPOOL_SUFFIX = ".queue"
+
+    def __init__(self, directory, window, batch_max, keep=1000):
+        self.directory = directory
+        self.window = window
+        self.batch_max = batch_max
+        self._cond = threading.Condition()
+        self._pending = []
+        self._seq = 0
+        # Sequence numbers of waiting submits, and the errors that failed
+        # them; waiting writes are dropped on failure, not retried.
+        self._waiting = set()
+        self._failed = {}
+        self._flush_ms = deque(maxlen=keep)
+        self._lag_ms = deque(maxlen=keep)
+        self.counters = dict.fromkeys(
+            ["submitted", "written", "batches", "errors", "recovered"], 0)
+        self.max_depth = 0
+        self.last_error = None
+        self._recover()
+        # A writer left behind by a cleared st.cache_resource still holds
+        # this process's first spool, so take the next free name.
+        for generation in itertools.count():
+            self.spool_path = self._spool_path(os.getpid(), generation)
+            self._spool = self._open_spool(self.spool_path)
+            if self._spool is not None:
+                break
+        threading.Thread(target=self._run, name="order-writer",
+                         daemon=True).start()
+
+    def _spool_path(self, pid, generation=0):
+        name = f"{pid}.{generation}" if generation else str(pid)
+        return os.path.join(self.directory,
+                            f"{self.SPOOL_PREFIX}{name}{self.SPOOL_SUFFIX}")
+
+    @staticmethod
+    def _open_spool(path):
+        while True:
+            spool = open(path, 'ab')
+            if not try_lock_file(spool.fileno()):
+                spool.close()
+                return None  # another writer's queue
+            # Another worker's recovery may have removed the file between
+            # our open and lock; then start over with a fresh one.
+            try:
+                if os.stat(path).st_ino == os.fstat(spool.fileno()).st_ino:
+                    return spool
+            except OSError:
+                pass
+            spool.close()
+
+    @staticmethod
+    def _unflushed(raw):
+        entries = [json.loads(line) for line in raw.splitlines()
+                   if line.strip()]
+        flushed = max((e["seq"] for e in entries if e["op"] == "flushed"),
+                      default=0)
+        return [(e["op"], e["value"]) for e in entries
+                if e["op"] != "flushed" and e["seq"] > flushed]
+
+    def _recover(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(self.SPOOL_PREFIX)
+                    and name.endswith(self.SPOOL_SUFFIX)):
+                continue
+            path = os.path.join(self.directory, name)
+            with open(path, 'r+b') as f:
+                if not try_lock_file(f.fileno()):
+                    continue  # a live worker's queue
+                try:
+                    ops = self._unflushed(f.read().decode("utf-8"))
+                    for start in range(0, len(ops), self.batch_max):
+                        DataManager.write_orders(
+                            ops[start:start + self.batch_max])
+                except Exception as e:
+                    self.counters["errors"] += 1
+                    self.last_error = f"recovering {name}: {e}"
+                    continue
+                self.counters["recovered"] += len(ops)
+                # Emptied first, so a worker that opened it meanwhile
+                # finds nothing left to replay.
+                f.truncate(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _log(self, entry):
+        # Caller holds self._cond.
+        self._spool.write((json.dumps(entry) + "\n").encode("utf-8"))
+        self._spool.flush()
+        os.fsync(self._spool.fileno())
+
+    def _rotate(self, flushed):
+        # Caller holds self._cond. The replacement is locked before it
+        # takes the spool's name, so recovery never sees it unheld.
+        if not self._pending:
+            self._spool.truncate(0)
+            return
+        path = self.spool_path
+        tmp_path = f"{path}.tmp"
+        spool = open(tmp_path, 'wb')
+        try:
+            try_lock_file(spool.fileno())
+            spool.write("".join(
+                json.dumps({"seq": seq, "op": op, "value": value}) + "\n"
+                for seq, op, value, _ in self._pending).encode("utf-8"))
+            spool.flush()
+            os.fsync(spool.fileno())
+            os.replace(tmp_path, path)
+        except OSError:
+            # Windows cannot rename over the open spool; mark the batch
+            # done in place instead, as the spool grows until it drains.
+            spool.close()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            if flushed is not None:
+                self._log({"seq": flushed, "op": "flushed"})
+            return
+        self._spool.close()
+        self._spool = spool
+
+    def submit(self, op, value, wait=not WRITE_BEHIND):
+        """Queue ``("order", order)`` or ``("cancel", order_id)``.
+
+        Returns once the operation is in the spool, or once it is in
+        storage when ``wait`` is set; then a failed write raises its error.
+        """
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            self._log({"seq": seq, "op": op, "value": value})
+            self._pending.append((seq, op, value, time.monotonic()))
+            self.counters["submitted"] += 1
+            self.max_depth = max(self.max_depth, len(self._pending))
+            if wait:
+                self._waiting.add(seq)
+            self._cond.notify_all()
+            if not wait:
+                return
+            while seq not in self._failed and \
+                    any(p[0] == seq for p in self._pending):
+                self._cond.wait()
+            self._waiting.discard(seq)
+            error = self._failed.pop(seq, None)
+        if error is not None:
+            raise error
+
+    def pending_ops(self):
+        with self._cond:
+            return [(op, value) for _, op, value, _ in self._pending]
+
+    def flush(self, seq=None, timeout=None):
+        """Wait until everything up to ``seq`` (default: all) is written."""
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._cond:
+            seq = self._seq if seq is None else seq
+            while self._pending and self._pending[0][0] <= seq:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.batch_max:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._pending[:self.batch_max]
+
+    def _run(self):
+        failures = 0
+        while True:
+            batch = self._next_batch()
+            start = time.monotonic()
+            try:
+                DataManager.write_orders(
+                    [(op, value) for _, op, value, _ in batch])
+            except Exception as e:
+                # Queued writes are kept and retried; they are in the spool.
+                # Writes whose caller waits get the error back instead.
+                failures += 1
+                with self._cond:
+                    self.counters["errors"] += 1
+                    self.last_error = str(e)
+                    failed = {seq for seq, _, _, _ in batch} & self._waiting
+                    if failed:
+                        self._pending = [p for p in self._pending
+                                         if p[0] not in failed]
+                        self._failed.update(dict.fromkeys(failed, e))
+                        self._rotate(None)
+                        self._cond.notify_all()
+                time.sleep(min(0.1 * 2 ** failures, 5.0))
+                continue
+            failures = 0
+            done = time.monotonic()
+            with self._cond:
+                del self._pending[:len(batch)]
+                self._rotate(batch[-1][0])
+                self.counters["written"] += len(batch)
+                self.counters["batches"] += 1
+                self._flush_ms.append((done - start) * 1000)
+                self._lag_ms.extend((done - queued) * 1000
+                                    for _, _, _, queued in batch)
+                self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            flush_ms = list(self._flush_ms)
+            lag_ms = list(self._lag_ms)
+            stats = dict(self.counters, depth=len(self._pending),
+                         max_depth=self.max_depth,
+                         last_error=self.last_error)
+        stats["batch_avg"] = stats["written"] / stats["batches"] \
+            if stats["batches"] else 0.0
+        for pct in (50, 95, 99):
+            stats[f"flush_p{pct}_ms"] = percentile(flush_ms, pct)
+            stats[f"lag_p{pct}_ms"] = percentile(lag_ms, pct)
+        return stats
+
+
+@st.cache_resource
+def get_order_writer():
+    writer = OrderWriter(os.path.dirname(
+        os.path.abspath(DataManager.HISTORY_FILE)),
+        WRITE_BATCH_WINDOW_MS / 1000, WRITE_BATCH_MAX)
+    # Give queued writes a chance to land when the server shuts down.
+    atexit.register(writer.flush, timeout=10)
+    return writer
+
+
+class ThumbnailCache:
+    """Resized, recompressed copies of product images.
+
+    Thumbnails are named after a hash of the source file's contents, so an
+    edited image gets a fresh thumbnail and an unchanged one is never
+    rebuilt. Sources are re-checked at most every ``recheck`` seconds,
+    which keeps the per-rerun cost to a dict lookup.
+    """
+
+    SIZES = {"card": 480, "icon": 100}
+
+    def __init__(self, directory, quality=80, recheck=5.0):
+        self.directory = directory
+        self.quality = quality
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._thumbs = {}
+
+    def _digest(self, source):
+        # Returns None when the source image does not exist.
+        now = time.monotonic()
+        entry = self._sources.get(source)
+        if entry is not None and now - entry[0] < self.recheck:
+            return entry[2]
+        sig = DataStore._signature(source) if source else None
+        if sig is None:
+            digest = None
+        elif entry is not None and entry[1] == sig:
+            digest = entry[2]
+        else:
+            with open(source, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:16]
+        self._sources[source] = (now, sig, digest)
+        return digest
+
+    def path(self, source, size):
+        """Thumbnail path for ``source`` at ``size``, or None if missing."""
+        with self._lock:
+            digest = self._digest(source)
+            if digest is None:
+                return None
+            key = (digest, size)
+            thumb = self._thumbs.get(key)
+            if thumb is None:
+                thumb = self._build(source, digest, size)
+                self._thumbs[key] = thumb
+            return thumb
+
+    def _build(self, source, digest, size):
+        width = self.SIZES[size]
+        thumb = os.path.join(self.directory, f"{digest}_{width}.jpg")
+        if os.path.exists(thumb):
+            return thumb
+        try:
+            from PIL import Image
+            os.makedirs(self.directory, exist_ok=True)
+            with Image.open(source) as im:
+                im.thumbnail((width, width * 4))
+                tmp_path = f"{thumb}.{os.getpid()}.tmp"
+                im.convert("RGB").save(tmp_path, "JPEG", quality=self.quality,
+                                       optimize=True, progressive=True)
+            os.replace(tmp_path, thumb)
+            return thumb
+        except Exception:
+            # Fall back to the original rather than losing the image.
+            return source
+
+    def warm(self, products):
+        for p in products:
+            for size in self.SIZES:
+                self.path(p.get('image', ''), size)
+
+
+@st.cache_resource
+def get_thumbnail_cache():
+    cache = ThumbnailCache(THUMBNAIL_DIR)
+    if THUMBNAIL_EAGER:
+        threading.Thread(target=cache.warm,
+                         args=(DataManager.load_products(),),
+                         daemon=True).start()
+    return cache
+
+# ==========================================
+# 🤖 PART 2: AI LOGIC (UPDATED FOR CART)
+# ==========================================
+
+# LLM gateway: "gemini", or offline "stub", "rules" (deterministic cart
+# commands) or "replay" (recorded replies), concurrent model calls,
+# requests per second (with burst), per-call deadline in seconds, retries
+# on transient errors and how many calls may wait.
+LLM_BACKEND = get_setting("LLM_BACKEND", "gemini")
+LLM_MODEL = get_setting("LLM_MODEL", "gemini-2.5-flash")
+LLM_MAX_CONCURRENCY = int(get_setting("LLM_MAX_CONCURRENCY", 8))
+LLM_RATE_LIMIT = float(get_setting("LLM_RATE_LIMIT", 5))
+LLM_BURST = int(get_setting("LLM_BURST", 10))
+LLM_TIMEOUT = float(get_setting("LLM_TIMEOUT", 30))
+LLM_MAX_RETRIES = int(get_setting("LLM_MAX_RETRIES", 2))
+LLM_MAX_QUEUE = int(get_setting("LLM_MAX_QUEUE", 32))
+STUB_LATENCY = float(get_setting("STUB_LATENCY", 0.2))
+# LLM_RECORD appends every model call to a JSON lines file; the replay
+# backend serves LLM_REPLAY (default: the same file) back, each call
+# taking REPLAY_LATENCY seconds, or as long as it did when recorded.
+LLM_RECORD = get_setting("LLM_RECORD", "")
+LLM_REPLAY = get_setting("LLM_REPLAY", LLM_RECORD or "llm_recordings.jsonl")
+REPLAY_LATENCY = get_setting("REPLAY_LATENCY", "recorded")
+
+# --- LLM GATEWAY ---
+
+# Upstream errors worth retrying, by class name so google.api_core need
+# not be imported here.
+RETRYABLE_ERRORS = frozenset([
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+    "InternalServerError", "DeadlineExceeded", "GatewayTimeout",
+    "TimeoutError", "ConnectionError", "ConnectionResetError",
+])
+
+
+class GatewayError(Exception):
+    pass
+
+
+class GatewayTimeout(GatewayError):
+    pass
+
+
+class GatewayOverloaded(GatewayError):
+    pass
+
+
+class ModelBackend:
+    """Text generation backend behind the LLM gateway."""
+
+    name = "base"
+
+    def generate(self, prompt, timeout):
+        raise NotImplementedError
+
+    def stream(self, prompt, timeout):
+        yield self.generate(prompt, timeout)
+
+
+class GeminiBackend(ModelBackend):
+    """Gemini client, imported and configured on the first model call.
+
+    google.generativeai takes about a second to import, so processes and
+    sessions that never talk to Aura don't pay for it.
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key, model_name, json_mode=False):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.json_mode = json_mode
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                config = {"response_mime_type": "application/json"} \
+                    if self.json_mode else None
+                self._model = genai.GenerativeModel(
+                    self.model_name, generation_config=config)
+            return self._model
+
+    def generate(self, prompt, timeout):
+        return self.model.generate_content(
+            prompt, request_options={"timeout": timeout}).text
+
+    def stream(self, prompt, timeout):
+        for chunk in self.model.generate_content(
+                prompt, stream=True, request_options={"timeout": timeout}):
+            yield chunk.text
+
+
+class StubBackend(ModelBackend):
+    """Offline stand-in with a fixed latency, for load tests."""
+
+    name = "stub"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate(self, prompt, timeout):
+        time.sleep(self.latency)
+        query = prompt.rsplit("User Input:", 1)[-1].strip()
+        return f"(offline) Aura heard: {query}"
+
+    def stream(self, prompt, timeout):
+        yield from word_chunks(self.generate(prompt, timeout))
+
+
+def word_chunks(text):
+    """Split ``text`` into streaming chunks of one word each."""
+    for i, word in enumerate(text.split(" ")):
+        yield word if i == 0 else " " + word
+
+
+def prompt_query(prompt):
+    """The user's question in an Aura prompt, or None for other prompts."""
+    if "User Input:" not in prompt:
+        return None
+    return prompt.rsplit("User Input:", 1)[1].strip()
+
+
+class RecordingBackend(ModelBackend):
+    """Passes calls to ``inner`` and appends each prompt/reply pair to a
+    JSON lines file that ReplayBackend can serve back.
+
+    Each record keeps the prompt, the reply, its streamed chunks, the
+    latency and the time to the first chunk, all in seconds.
+    """
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.name = f"record:{inner.name}"
+        self._lock = threading.Lock()
+
+    def _save(self, prompt, chunks, start, ttft):
+        record = {
+            "prompt_sha1": hashlib.sha1(prompt.encode()).hexdigest(),
+            "query": prompt_query(prompt),
+            "prompt": prompt,
+            "reply": "".join(chunks),
+            "chunks": chunks,
+            "latency": round(time.monotonic() - start, 4),
+            "ttft": round(ttft, 4),
+            "ts": round(time.time(), 3),
+        }
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def generate(self, prompt, timeout):
+        start = time.monotonic()
+        reply = self.inner.generate(prompt, timeout)
+        self._save(prompt, [reply], start, time.monotonic() - start)
+        return reply
+
+    def stream(self, prompt, timeout):
+        start = time.monotonic()
+        chunks, ttft = [], 0.0
+        for text in self.inner.stream(prompt, timeout):
+            if not chunks:
+                ttft = time.monotonic() - start
+            chunks.append(text)
+            yield text
+        self._save(prompt, chunks, start, ttft)
+
+
+class ReplayMiss(GatewayError):
+    pass
+
+
+class ReplayBackend(ModelBackend):
+    """Serves replies captured by RecordingBackend, without the network.
+
+    A prompt is looked up by its exact text first, then by the user's
+    question alone (the latest recording wins), so replays survive small
+    changes to the catalog or order context; anything else raises
+    ReplayMiss. ``latency`` is the synthetic delay per call in seconds,
+    or None to reuse each recording's own latency and time to first
+    chunk.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, latency=None):
+        self.path = path
+        self.latency = latency
+        self.by_prompt = {}
+        self.by_query = {}
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.by_prompt[record["prompt_sha1"]] = record
+                    if record.get("query"):
+                        self.by_query[record["query"]] = record
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(["exact", "query", "misses"], 0)
+
+    def _lookup(self, prompt):
+        record = self.by_prompt.get(
+            hashlib.sha1(prompt.encode()).hexdigest())
+        hit = "exact"
+        if record is None:
+            record = self.by_query.get(prompt_query(prompt))
+            hit = "query" if record is not None else "misses"
+        with self._lock:
+            self.counters[hit] += 1
+        if record is None:
+            raise ReplayMiss(f"No recording for this prompt in {self.path}")
+        return record
+
+    def _delays(self, record):
+        if self.latency is not None:
+            return self.latency, 0.0
+        return record["ttft"], max(record["latency"] - record["ttft"], 0.0)
+
+    def generate(self, prompt, timeout):
+        record = self._lookup(prompt)
+        time.sleep(sum(self._delays(record)))
+        return record["reply"]
+
+    def stream(self, prompt, timeout):
+        record = self._lookup(prompt)
+        first, rest = self._delays(record)
+        chunks = record.get("chunks") or [record["reply"]]
+        time.sleep(first)
+        for i, text in enumerate(chunks):
+            if i:
+                time.sleep(rest / (len(chunks) - 1))
+            yield text
+
+
+class RuleBackend(ModelBackend):
+    """Deterministic offline Aura that follows the cart instructions.
+
+    Products are those named in the prompt's "Relevant Products" section,
+    so replies depend only on the prompt. "add 2 <name>", "remove
+    <name>", "set <name> to 3" and "show my cart" become cart commands;
+    "yes" adds the product mentioned last in the conversation; naming a
+    product alone gets its description and an offer to add it. JSON mode
+    prompts get a JSON envelope. Summary prompts get the new messages
+    back, cut to 120 words.
+    """
+
+    name = "rules"
+
+    REMOVE_WORDS = frozenset(["remove", "delete", "drop", "without"])
+    SET_WORDS = frozenset(["set", "change", "make", "update"])
+    ADD_WORDS = frozenset(["add", "buy", "want", "take", "get", "order",
+                           "please", "need"])
+    YES_WORDS = frozenset(["yes", "yeah", "yep", "sure", "ok", "okay"])
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    @staticmethod
+    def _products(prompt):
+        section = prompt.split("Relevant Products:\n", 1)
+        if len(section) < 2:
+            return []
+        products = []
+        for line in section[1].split("\n"):
+            if not line.startswith("{"):
+                break
+            products.append(json.loads(line))
+        # Longest names first so "Glow 12" wins over "Glow 1".
+        return sorted(products, key=lambda p: -len(p["name"]))
+
+    def _mentions(self, text, products):
+        """``(position, product, qty)`` for each product named in ``text``."""
+        found = []
+        lowered = text.lower()
+        for p in products:
+            at = lowered.rfind(p["name"].lower())
+            if at < 0 or any(s <= at < s + len(q["name"])
+                             for s, q, _ in found):
+                continue
+            before = TOKEN_RE.findall(lowered[:at])
+            qty = int(before[-1]) if before and before[-1].isdigit() else None
+            found.append((at, p, qty))
+        return sorted(found, key=lambda m: m[0])
+
+    def reply(self, prompt):
+        """``(text, commands)`` for an Aura prompt."""
+        query = prompt_query(prompt)
+        products = self._products(prompt)
+        words = set(TOKEN_RE.findall(query.lower()))
+        mentions = self._mentions(query, products)
+        if not mentions and words & self.YES_WORDS:
+            history = prompt.split("Current Conversation History:", 1)[-1]
+            history = history.split("Catalog:", 1)[0]
+            earlier = self._mentions(history, products)
+            mentions = earlier[-1:]
+            words |= {"add"}
+        if words & {"cart", "basket"} and not mentions:
+            return "Here is your cart.", [{"action": "show_cart"}]
+        if not mentions:
+            return f"(offline) Aura heard: {query}", []
+        if words & self.REMOVE_WORDS:
+            return "Removing that now!", [
+                {"action": "remove_from_cart", "item_name": p["name"]}
+                for _, p, _ in mentions]
+        if words & self.SET_WORDS:
+            numbers = [int(t) for t in TOKEN_RE.findall(query.lower())
+                       if t.isdigit()]
+            return "Updating your cart!", [
+                {"action": "set_quantity", "item_name": p["name"],
+                 "qty": numbers[-1] if numbers else 1}
+                for _, p, _ in mentions]
+        if words & self.ADD_WORDS or any(n for _, _, n in mentions):
+            return "Adding those now!", [
+                {"action": "add_to_cart", "item_name": p["name"],
+                 "qty": n or 1} for _, p, n in mentions]
+        _, p, _ = mentions[0]
+        return (f"{p['name']} ({p['category']}, LKR {p['price']}): "
+                f"{p.get('desc') or ''} Do you want to add this to your "
+                f"cart?"), []
+
+    def generate(self, prompt, timeout):
+        time.sleep(self.latency)
+        if prompt_query(prompt) is None:
+            turns = prompt.split("New messages:", 1)[-1].split()
+            return " ".join(turns[:120])
+        text, commands = self.reply(prompt)
+        if AURA_JSON_INSTRUCTIONS.strip() in prompt:
+            return json.dumps({"reply": text, "commands": commands})
+        return " ".join([text] + [json.dumps(c) for c in commands])
+
+    def stream(self, prompt, timeout):
+        yield from word_chunks(self.generate(prompt, timeout))
+
+
+class TokenBucket:
+    """Allows ``rate`` acquisitions per second with bursts up to ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                raise GatewayTimeout("Rate limit wait exceeds the deadline")
+            time.sleep(wait)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class LLMGateway:
+    """Process-wide front door for model calls.
+
+    - at most ``max_concurrency`` calls run at once (worker pool size)
+    - a token bucket limits the request rate
+    - callers wait no longer than ``timeout`` seconds
+    - transient errors are retried with jittered exponential backoff
+    - identical prompts already in flight share a single call
+    - at most ``max_queue`` calls may wait for a worker; the rest are
+      rejected with GatewayOverloaded
+    """
+
+    def __init__(self, backend, max_concurrency, rate, burst, timeout,
+                 max_retries, max_queue):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self._bucket = TokenBucket(rate, burst)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._latencies = deque(maxlen=1000)
+        self.queued = 0
+        self.running = 0
+        self.counters = dict.fromkeys(
+            ["calls", "completed", "failed", "retries", "coalesced",
+             "rejected", "timeouts", "cut_short"], 0)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _submit(self, fn, *args):
+        # Caller holds self._lock.
+        if self.queued >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise GatewayOverloaded("Too many requests waiting")
+        self.queued += 1
+        self.counters["calls"] += 1
+        return self._executor.submit(self._run, fn, *args)
+
+    def _run(self, fn, *args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        start = time.monotonic()
+        try:
+            result = fn(*args)
+            self._count("completed")
+            return result
+        except Exception:
+            self._count("failed")
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+                self._latencies.append(time.monotonic() - start)
+
+    def _with_retries(self, deadline, attempt_fn):
+        attempt = 0
+        while True:
+            self._bucket.acquire(deadline)
+            try:
+                return attempt_fn(max(deadline - time.monotonic(), 0.1))
+            except Exception as e:
+                if type(e).__name__ not in RETRYABLE_ERRORS or \
+                        attempt >= self.max_retries:
+                    raise
+                backoff = random.uniform(0, 0.5 * 2 ** attempt)
+                if time.monotonic() + backoff >= deadline:
+                    raise
+                attempt += 1
+                self._count("retries")
+                time.sleep(backoff)
+
+    def _generate(self, prompt, deadline):
+        return self._with_retries(
+            deadline, lambda timeout: self.backend.generate(prompt, timeout))
+
+    def generate(self, prompt, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        with self._lock:
+            future = self._inflight.get(prompt)
+            if future is not None:
+                self.counters["coalesced"] += 1
+            else:
+                future = self._submit(self._generate, prompt, deadline)
+                self._inflight[prompt] = future
+                future.add_done_callback(
+                    lambda f: self._inflight.pop(prompt, None))
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            self._count("timeouts")
+            raise GatewayTimeout("Model call exceeded its deadline")
+
+    def _pump(self, prompt, deadline, chunks):
+        emitted = []
+
+        def attempt(timeout):
+            # Only retry while nothing has reached the caller yet.
+            try:
+                for text in self.backend.stream(prompt, timeout):
+                    emitted.append(text)
+                    chunks.put(text)
+            except Exception:
+                if emitted:
+                    raise RuntimeError("Stream interrupted")
+                raise
+
+        try:
+            self._with_retries(deadline, attempt)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+            raise
+
+    def stream(self, prompt, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        chunks = queue.Queue()
+        with self._lock:
+            self._submit(self._pump, prompt, deadline, chunks)
+        started = False
+        while True:
+            try:
+                item = chunks.get(
+                    timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self._count("timeouts")
+                item = GatewayTimeout("Model stream exceeded its deadline")
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                if started:
+                    self._count("cut_short")
+                raise item
+            started = True
+            yield item
+
+    def metrics(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = dict(self.counters, queued=self.queued,
+                         in_flight=self.running)
+        for pct in (50, 95, 99):
+            stats[f"p{pct}"] = percentile(latencies, pct)
+        return stats
+
+
+@st.cache_resource
+def get_llm_gateway():
+    if LLM_BACKEND == "stub":
+        backend = StubBackend(STUB_LATENCY)
+    elif LLM_BACKEND == "rules":
+        backend = RuleBackend(STUB_LATENCY)
+    elif LLM_BACKEND == "replay":
+        backend = ReplayBackend(
+            LLM_REPLAY, None if REPLAY_LATENCY == "recorded"
+            else float(REPLAY_LATENCY))
+    else:
+        backend = GeminiBackend(GEMINI_API_KEY, LLM_MODEL, AURA_JSON_MODE)
+    if LLM_RECORD and LLM_BACKEND != "replay":
+        backend = RecordingBackend(backend, LLM_RECORD)
+    return LLMGateway(backend, LLM_MAX_CONCURRENCY, LLM_RATE_LIMIT,
+                      LLM_BURST, LLM_TIMEOUT, LLM_MAX_RETRIES, LLM_MAX_QUEUE)
+
+
+def ai_error_message(error):
+    if isinstance(error, GatewayTimeout):
+        return "Aura is taking too long to answer. Please try again."
+    if isinstance(error, GatewayOverloaded):
+        return "Aura is helping a lot of people right now. Please try again shortly."
+    return "The spirits are quiet today."
+
+# --- PROMPT CONTEXT ---
+
+# Prompt size limits for get_ai_response (tokens are estimated as chars / 4).
+PROMPT_TOKEN_BUDGET = int(get_setting("PROMPT_TOKEN_BUDGET", 3000))
+PROMPT_TOP_K = int(get_setting("PROMPT_TOP_K", 8))
+PROMPT_RECENT_ORDERS = int(get_setting("PROMPT_RECENT_ORDERS", 10))
+
+# Aura reply cache: entries in memory, seconds to live, and an optional
+# SQLite file that keeps replies across restarts.
+RESPONSE_CACHE_SIZE = int(get_setting("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(get_setting("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_PATH = get_setting("RESPONSE_CACHE_PATH", "")
+
+# Render Aura replies token by token as the model generates them.
+AURA_STREAMING = get_setting("AURA_STREAMING", "1") not in ("0", "false")
+# Ask Gemini for a JSON reply ({"reply": ..., "commands": [...]}) instead of
+# prose with embedded commands. Replies then appear all at once.
+AURA_JSON_MODE = get_setting("AURA_JSON_MODE", "0") not in ("0", "false")
+
+# Conversation memory: turns kept verbatim per session, how many evicted
+# turns to fold into the summary at once, the token budget for history in
+# the prompt, and how many messages the chat shows before "Show earlier".
+CHAT_MAX_TURNS = int(get_setting("CHAT_MAX_TURNS", 40))
+CHAT_SUMMARY_BATCH = int(get_setting("CHAT_SUMMARY_BATCH", 10))
+CHAT_HISTORY_TOKENS = int(get_setting("CHAT_HISTORY_TOKENS", 800))
+CHAT_WINDOW = int(get_setting("CHAT_WINDOW", 20))
+
+# Replies to these depend on the conversation, not just the question.
+FOLLOW_UP_WORDS = frozenset(
+    "yes yeah yep no nope ok okay sure those these them that it one ones "
+    "both all same another more".split())
+
+AURA_INSTRUCTIONS = """
+    *** IMPORTANT CART INSTRUCTIONS ***
+    You change the user's cart by writing JSON commands, one object per item:
+    { "action": "add_to_cart", "item_name": "Exact Product Name from Catalog", "qty": Integer }
+    { "action": "remove_from_cart", "item_name": "Exact Product Name from Catalog" }
+    { "action": "set_quantity", "item_name": "Exact Product Name from Catalog", "qty": Integer }
+    { "action": "show_cart" }
+
+    1. If the user asks about a product, describe it briefly and ask: "Do you want to add this to your cart?"
+    2. As soon as the user asks to add, remove or change items, write the commands in the same reply, with one short sentence. Do not ask for a quantity again if they gave one; if they gave none for an add, use 1.
+    3. When the user agrees to an item you offered, add it with the quantity they said (1 if none).
+
+    Example: User says "2 Heavenly Hues and a Radiant Glow please", you output:
+    Adding those now! { "action": "add_to_cart", "item_name": "Heavenly Hues", "qty": 2 } { "action": "add_to_cart", "item_name": "Radiant Glow", "qty": 1 }
+
+    For all other normal conversation, just reply with text (no JSON).
+    """
+AURA_JSON_INSTRUCTIONS = """
+    Reply with exactly one JSON object:
+    { "reply": "Text for the user", "commands": [ ...zero or more cart commands... ] }
+    """
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def build_prompt(query, chat_history_str, products, history, cart_txt,
+                 budget=None, top_k=None):
+    """Build the Aura prompt with only the context relevant to ``query``.
+
+    The fixed parts (persona, cart, conversation, instructions) always go
+    in. Matching products and then the most recent orders are added until
+    the token budget is used. Returns ``(prompt, stats)``.
+    """
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    top_k = PROMPT_TOP_K if top_k is None else top_k
+    index = get_catalog(products)
+
+    head = f"""
+    You are Aura, the AI agent for Dream Spells.
+    User: Ishara Stanley.
+    Cart: {cart_txt}
+    Current Conversation History: {chat_history_str}
+    """
+    instructions = AURA_INSTRUCTIONS + \
+        (AURA_JSON_INSTRUCTIONS if AURA_JSON_MODE else "")
+    tail = f"{instructions}\nUser Input: {query}"
+    overview = ", ".join(f"{c} ({n})" for c, n in
+                         sorted(index.category_counts.items()))
+    sections = [f"Catalog: {len(products)} products. Categories: {overview}"]
+    used = estimate_tokens(head) + estimate_tokens(tail) + \
+        estimate_tokens(sections[0])
+
+    # Products matching the question first, then ones from the
+    # conversation so follow-ups like "I'll take 2 of those" still resolve.
+    matches = index.search(query, top_k)
+    if len(matches) < top_k:
+        seen = {p['id'] for p in matches}
+        matches += [p for p in index.search(chat_history_str, top_k)
+                    if p['id'] not in seen][:top_k - len(matches)]
+    product_lines = []
+    for p in matches:
+        line = json.dumps({k: p.get(k) for k in
+                           ("id", "name", "category", "price", "desc")})
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        product_lines.append(line)
+        used += cost
+    if product_lines:
+        sections.append("Relevant Products:\n" + "\n".join(product_lines))
+
+    order_lines = []
+    if history:
+        total = DataManager.spending_stats()["total"]
+        summary = (f"History: {len(history)} orders, "
+                   f"total spent LKR {total}. Most recent first:")
+        used += estimate_tokens(summary)
+        for o in reversed(history[-PROMPT_RECENT_ORDERS:]):
+            line = (f"{o['order_id']} | {o['date']} | {order_items_text(o)} | "
+                    f"LKR {o['total']} | {o['status']}")
+            cost = estimate_tokens(line)
+            if used + cost > budget:
+                break
+            order_lines.append(line)
+            used += cost
+        sections.append("\n".join([summary] + order_lines))
+
+    prompt = head + "\n".join(sections) + tail
+    stats = {
+        "prompt_chars": len(prompt),
+        "prompt_tokens": estimate_tokens(prompt),
+        "products_sent": len(product_lines),
+        "orders_sent": len(order_lines),
+        "catalog_size": len(products),
+        "history_size": len(history),
+    }
+    return prompt, stats
+
+
+class ResponseCache:
+    """LRU + TTL cache of Aura replies, with an optional SQLite disk tier.
+
+    ``set_catalog`` drops every entry when the catalog fingerprint changes,
+    so prices and descriptions in cached replies never go stale.
+    """
+
+    def __init__(self, max_entries, ttl, path=""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, "
+                "reply TEXT, latency REAL, tokens INTEGER, expires REAL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, "
+                "value TEXT)")
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'catalog'").fetchone()
+            self._catalog = row[0] if row else None
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+
+    def set_catalog(self, fingerprint):
+        with self._lock:
+            if fingerprint == self._catalog:
+                return
+            self._catalog = fingerprint
+            self._entries.clear()
+            if self._db:
+                with self._db:
+                    self._db.execute("DELETE FROM replies")
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('catalog', ?)",
+                        (fingerprint,))
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db:
+                entry = self._db.execute(
+                    "SELECT expires, reply, latency, tokens FROM replies "
+                    "WHERE key = ?", (key,)).fetchone()
+            if entry is None or entry[0] < now:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+            self.hits += 1
+            self.saved_seconds += entry[2]
+            self.saved_tokens += entry[3]
+            return entry[1]
+
+    def put(self, key, reply, latency, tokens):
+        entry = (time.time() + self.ttl, reply, latency, tokens)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+            if self._db:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO replies "
+                        "(key, expires, reply, latency, tokens) "
+                        "VALUES (?, ?, ?, ?, ?)", (key,) + entry)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "saved_seconds": self.saved_seconds,
+            "saved_tokens": self.saved_tokens,
+        }
+
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                         RESPONSE_CACHE_PATH)
+
+
+def response_cache_key(query, catalog_fingerprint, cart_txt, history):
+    """Cache key for a standalone question, or None for follow-up turns.
+
+    Answers to "yes", "2" or "I'll take those" depend on the conversation,
+    which is not part of the key, so they are never cached. The prompt
+    carries recent orders and total spend, so the order count and the
+    latest order ID are part of the key: a checkout or cancellation
+    retires answers like "what did I order last?".
+    """
+    tokens = TOKEN_RE.findall(query.lower())
+    if len(tokens) < 2 or FOLLOW_UP_WORDS.intersection(tokens) or \
+            all(t.isdigit() for t in tokens):
+        return None
+    normalized = " ".join(t for t in tokens if t not in STOPWORDS)
+    history_version = f"{len(history)}:{history[-1]['order_id']}" \
+        if history else "0"
+    return hashlib.sha1("\n".join(
+        [normalized, catalog_fingerprint, cart_txt,
+         history_version]).encode()).hexdigest()
+
+
+def prepare_ai_request(query, chat_history_str):
+    """Build the prompt and look up the reply cache.
+
+    Returns ``(prompt, stats, cache_key, cached_reply)``. The stats dict,
+    which times prompt construction (``prompt_ms``) apart from the model
+    call, is also published as ``st.session_state.last_prompt_stats``.
+    """
+    prod, hist = DataManager.load_data()
+    cart_txt = json.dumps(st.session_state.cart.to_list()) \
+        if 'cart' in st.session_state else "Empty"
+
+    start = time.perf_counter()
+    with get_profiler().span("prompt"):
+        prompt, stats = build_prompt(
+            query, chat_history_str, prod, hist, cart_txt)
+    stats["prompt_ms"] = (time.perf_counter() - start) * 1000
+    cache = get_response_cache()
+    fingerprint = get_catalog(prod).fingerprint
+    cache.set_catalog(fingerprint)
+    key = response_cache_key(query, fingerprint, cart_txt, hist)
+    reply = cache.get(key) if key else None
+    stats["cached"] = reply is not None
+    st.session_state.last_prompt_stats = stats
+    return prompt, stats, key, reply
+
+
+def get_ai_response(query, chat_history_str):
+    prompt, stats, key, reply = prepare_ai_request(query, chat_history_str)
+    start = time.perf_counter()
+    try:
+        if reply is None:
+            with get_profiler().span("llm"):
+                reply = get_llm_gateway().generate(prompt)
+            if key:
+                get_response_cache().put(
+                    key, reply, time.perf_counter() - start,
+                    stats["prompt_tokens"])
+        return reply
+    except Exception as e:
+        stats["error"] = type(e).__name__
+        return ai_error_message(e)
+    finally:
+        stats["latency"] = stats["ttft"] = time.perf_counter() - start
+
+
+CUT_SHORT_NOTE = "_(Aura's response was cut short. Please try again.)_"
+
+
+def stream_ai_response(query, chat_history_str):
+    """Yield the reply in chunks as the model generates it.
+
+    Records time-to-first-token (``ttft``) separately from the total
+    ``latency`` in the prompt stats. A stream that fails after some output
+    ends with CUT_SHORT_NOTE and sets ``cut_short`` in the stats.
+    """
+    prompt, stats, key, reply = prepare_ai_request(query, chat_history_str)
+    start = time.perf_counter()
+    parts = []
+    try:
+        if reply is not None:
+            stats["ttft"] = time.perf_counter() - start
+            yield reply
+            return
+        with get_profiler().span("llm"):
+            for text in get_llm_gateway().stream(prompt):
+                if not text:
+                    continue
+                if not parts:
+                    stats["ttft"] = time.perf_counter() - start
+                parts.append(text)
+                yield text
+        if key:
+            get_response_cache().put(
+                key, "".join(parts), time.perf_counter() - start,
+                stats["prompt_tokens"])
+    except Exception as e:
+        stats["error"] = type(e).__name__
+        if not parts:
+            stats["ttft"] = time.perf_counter() - start
+            yield ai_error_message(e)
+        else:
+            stats["cut_short"] = True
+            yield f"\n\n{CUT_SHORT_NOTE}"
+    finally:
+        stats["latency"] = time.perf_counter() - start
+
+
+# --- CART COMMANDS ---
+
+# Fields each cart command takes, with their types and defaults.
+COMMAND_SCHEMAS = {
+    "add_to_cart": {"item_name": (str, None), "qty": (int, 1)},
+    "remove_from_cart": {"item_name": (str, None)},
+    "set_quantity": {"item_name": (str, None), "qty": (int, None)},
+    "show_cart": {},
+}
+COMMAND_ALIASES = {"add": "add_to_cart", "remove": "remove_from_cart",
+                   "set_qty": "set_quantity", "update_quantity": "set_quantity",
+                   "view_cart": "show_cart"}
+FENCE_RE = re.compile(r"```(?:json)?")
+
+
+def parse_command(obj):
+    """Validate one command object against COMMAND_SCHEMAS.
+
+    Returns the normalized command, an ``{"action": "invalid"}`` command
+    with an ``error`` when ``obj`` names an action but breaks its schema,
+    or None when ``obj`` is not a command at all.
+    """
+    if not isinstance(obj, dict) or "action" not in obj:
+        return None
+    action = COMMAND_ALIASES.get(obj["action"], obj["action"])
+    schema = COMMAND_SCHEMAS.get(action)
+    if schema is None:
+        return {"action": "invalid", "error": f"unknown action {obj['action']!r}"}
+    command = {"action": action}
+    for field, (kind, default) in schema.items():
+        value = obj.get(field, default)
+        if kind is int and isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if value is None or isinstance(value, bool) or not isinstance(value, kind):
+            return {"action": "invalid",
+                    "error": f"{action} needs {field} ({kind.__name__})"}
+        command[field] = value
+    if command.get("qty", 1) < (0 if action == "set_quantity" else 1):
+        return {"action": "invalid", "error": f"bad quantity {command['qty']}"}
+    return command
+
+
+def parse_commands(value):
+    """Commands in a parsed JSON value, as ``(commands, reply_text)``.
+
+    Accepts a single command object or a JSON-mode envelope
+    ``{"reply": ..., "commands": [...]}``, whose elements that are not
+    commands become invalid ones so the reply is still shown. Returns None
+    for anything else, so it is shown to the user as written.
+    """
+    if isinstance(value, dict) and isinstance(value.get("commands"), list):
+        commands = [parse_command(c) or
+                    {"action": "invalid", "error": f"not a command: {c!r}"}
+                    for c in value["commands"]]
+        return commands, str(value.get("reply") or "")
+    command = parse_command(value)
+    return None if command is None else ([command], "")
+
+
+class CommandScanner:
+    """Splits a model reply into prose and cart commands in one pass.
+
+    ``feed`` takes the reply in chunks as they stream in and returns the
+    prose that is safe to show so far. Top-level ``{...}`` objects are
+    held back until they close; those that parse as commands are
+    collected in ``commands``, anything else is given back as prose.
+    Braces inside JSON strings are handled, and ```json fences around
+    commands are dropped (text that might start a fence is held back
+    until the next chunk settles it). ``close`` flushes the rest.
+    """
+
+    FENCE = "```json"
+
+    def __init__(self, accept=parse_commands):
+        self.accept = accept
+        self.commands = []
+        self._obj = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._held = ""
+
+    def feed(self, text):
+        prose = [self._held]
+        self._held = ""
+        for ch in text:
+            if not self._depth:
+                if ch == "{":
+                    self._depth = 1
+                    self._obj = [ch]
+                else:
+                    prose.append(ch)
+                continue
+            self._obj.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if not self._depth:
+                    prose.append(self._finish())
+        return self._release("".join(prose))
+
+    def close(self):
+        rest = self._held + "".join(self._obj if self._depth else [])
+        self._held = ""
+        self._obj = []
+        self._depth = 0
+        self._in_string = self._escape = False
+        return FENCE_RE.sub("", rest)
+
+    def stream(self, chunks):
+        """Yield the prose of a streamed reply as it becomes safe to show."""
+        for chunk in chunks:
+            text = self.feed(chunk)
+            if text:
+                yield text
+        text = self.close()
+        if text:
+            yield text
+
+    def _finish(self):
+        raw = "".join(self._obj)
+        self._obj = []
+        try:
+            result = self.accept(json.loads(raw))
+        except ValueError:
+            result = None
+        if result is None:
+            return raw
+        commands, text = result
+        self.commands.extend(commands)
+        return text
+
+    def _release(self, text):
+        for size in range(min(len(text), len(self.FENCE) - 1), 0, -1):
+            if self.FENCE.startswith(text[-size:]):
+                self._held = text[-size:]
+                text = text[:-size]
+                break
+        return FENCE_RE.sub("", text)
+
+
+# --- CONVERSATION MEMORY ---
+
+SUMMARY_PROMPT = """
+    Update the summary of a shopping conversation between a user and Aura,
+    the Dream Spells assistant. Keep product names, quantities, cart
+    changes and the user's preferences; drop small talk. Reply with the
+    new summary only, in at most 120 words.
+
+    Current summary: {summary}
+
+    New messages:
+    {turns}
+    """
+
+
+class ConversationMemory:
+    """One session's chat, bounded in size.
+
+    The newest ``max_turns`` turns are kept verbatim as ``(role, text)``
+    tuples. Older turns move to ``pending`` and, ``batch`` at a time, are
+    folded into a rolling ``summary`` by the model on a background thread,
+    so the chat never waits for it. ``prompt_history`` assembles the
+    summary and the most recent turns that fit a token budget.
+    """
+
+    def __init__(self, greeting, max_turns=CHAT_MAX_TURNS,
+                 batch=CHAT_SUMMARY_BATCH):
+        self.max_turns = max_turns
+        self.batch = batch
+        self.turns = deque()
+        self.pending = []
+        self.summary = ""
+        self.evicted = 0
+        self._summarizing = False
+        self._lock = threading.Lock()
+        self.add("assistant", greeting)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add(self, role, text):
+        with self._lock:
+            self.turns.append((role, text))
+            while len(self.turns) > self.max_turns:
+                self.pending.append(self.turns.popleft())
+                self.evicted += 1
+        self._start_summary(get_llm_gateway())
+
+    def _start_summary(self, gateway):
+        with self._lock:
+            if self._summarizing or len(self.pending) < self.batch:
+                return
+            self._summarizing = True
+            batch = list(self.pending)
+        threading.Thread(target=self._summarize, args=(gateway, batch),
+                         daemon=True).start()
+
+    def window(self, size):
+        """The last ``size`` turns, oldest first."""
+        with self._lock:
+            return list(itertools.islice(
+                self.turns, max(len(self.turns) - size, 0), None))
+
+    def prompt_history(self, budget=CHAT_HISTORY_TOKENS):
+        """Summary, then as many recent turns as fit ``budget`` tokens.
+
+        Turns still waiting to be summarized are used if room is left.
+        """
+        with self._lock:
+            summary = self.summary
+            recent = list(self.turns)
+            pending = list(self.pending)
+        # The summary may use at most half the budget.
+        head = f"Summary of earlier conversation: {summary}"[:budget * 2] \
+            if summary else ""
+        used = estimate_tokens(head) if head else 0
+        lines = []
+        for turns in (recent, pending):
+            for role, text in reversed(turns):
+                line = f"{role}: {text}"
+                cost = estimate_tokens(line)
+                if used + cost > budget:
+                    break
+                lines.append(line)
+                used += cost
+            else:
+                continue
+            break
+        return "\n".join(([head] if head else []) + lines[::-1])
+
+    def _summarize(self, gateway, batch):
+        turns = "\n".join(f"{role}: {text}" for role, text in batch)
+        try:
+            summary = gateway.generate(SUMMARY_PROMPT.format(
+                summary=self.summary or "(none)", turns=turns)).strip()
+        except Exception:
+            summary = ""
+        with self._lock:
+            if summary:
+                self.summary = summary
+                del self.pending[:len(batch)]
+            # On failure the turns stay pending for the next attempt; the
+            # oldest are dropped if the model stays unavailable.
+            del self.pending[:max(len(self.pending) - 2 * self.batch, 0)]
+            self._summarizing = False
+        if summary:
+            self._start_summary(gateway)
+
+
+# ==========================================
+# ⚙️ PART 3: CALLBACKS
+# ==========================================
+class Cart:
+    """A session's cart: one line per product id, in the order added.
+
+    The item count and amount are updated on every change, so the header
+    badge and the cart popup never re-sum the lines. Lines snapshot the
+    catalog price when added; ``add`` rejects products that are not in the
+    catalog at that price, and ``reprice`` re-checks the snapshots before
+    checkout.
+    """
+
+    def __init__(self, items=()):
+        self.lines = OrderedDict()
+        self.count = 0
+        self.amount = 0
+        # Lines restored as-is; reprice() checks them before checkout.
+        for item in items:
+            line = self.lines.setdefault(item['id'], dict(item, qty=0))
+            line['qty'] += item['qty']
+            self.count += item['qty']
+            self.amount += item['qty'] * line['price']
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    def add(self, product, qty):
+        """Add ``qty`` of a catalog product. Raises ValueError if invalid."""
+        if not isinstance(qty, int) or qty < 1:
+            raise ValueError(f"Invalid quantity: {qty!r}")
+        listed = DataManager.product(product.get('id'))
+        if listed is None:
+            raise ValueError(f"{product.get('name')} is not in the catalog")
+        if product.get('price') != listed['price']:
+            raise ValueError(f"Price of {listed['name']} has changed")
+        line = self.lines.get(listed['id'])
+        if line is None:
+            line = self.lines[listed['id']] = {
+                "id": listed['id'],
+                "name": listed['name'],
+                "price": listed['price'],
+                "qty": 0,
+                "image": listed['image'],
+            }
+        line['qty'] += qty
+        self.count += qty
+        self.amount += qty * line['price']
+        return line
+
+    def set_qty(self, product_id, qty):
+        line = self.lines.get(product_id)
+        if line is None:
+            return
+        if qty < 1:
+            self.remove(product_id)
+            return
+        self.count += qty - line['qty']
+        self.amount += (qty - line['qty']) * line['price']
+        line['qty'] = qty
+
+    def remove(self, product_id):
+        line = self.lines.pop(product_id, None)
+        if line is not None:
+            self.count -= line['qty']
+            self.amount -= line['qty'] * line['price']
+
+    def clear(self):
+        self.lines.clear()
+        self.count = 0
+        self.amount = 0
+
+    def reprice(self):
+        """Sync line prices with the catalog; drop delisted products.
+
+        Returns the names of the lines that changed.
+        """
+        changed = []
+        for line in list(self.lines.values()):
+            listed = DataManager.product(line['id'])
+            if listed is None:
+                self.remove(line['id'])
+            elif listed['price'] != line['price']:
+                self.amount += (listed['price'] - line['price']) * line['qty']
+                line['price'] = listed['price']
+            else:
+                continue
+            changed.append(line['name'])
+        return changed
+
+    def to_list(self):
+        return list(self.lines.values())
+
+
+def init_session_state():
+    if "cart" not in st.session_state:
+        st.session_state.cart = Cart()
+    elif isinstance(st.session_state.cart, list):
+        # Sessions started before the cart model kept a plain list.
+        st.session_state.cart = Cart(st.session_state.cart)
+    if "chat_memory" not in st.session_state:
+        st.session_state.chat_memory = ConversationMemory(
+            "Welcome back, Ishara! Ask me about dreamcatchers.")
+
+
+def add_to_cart_callback(product, qty_key):
+    qty = st.session_state[qty_key]
+    try:
+        st.session_state.cart.add(product, qty)
+    except ValueError as e:
+        st.toast(f"Could not add to cart: {e}", icon="⚠️")
+        return
+    st.toast(f"Added {qty} {product['name']} to cart!", icon="🛒")
+
+
+def clear_cart_callback():
+    st.session_state.cart.clear()
+
+
+def remove_item_callback(product_id):
+    st.session_state.cart.remove(product_id)
+
+
+def clear_chat_callback():
+    st.session_state.chat_memory = ConversationMemory(
+        "Chat cleared. How can I help?")
+    st.session_state.chat_window = CHAT_WINDOW
+
+
+def show_earlier_callback():
+    st.session_state.chat_window = \
+        st.session_state.get("chat_window", CHAT_WINDOW) + CHAT_WINDOW
+
+
+def update_qty_callback(key, change):
+    if key in st.session_state:
+        new_val = st.session_state[key] + change
+        if 1 <= new_val <= 10:
+            st.session_state[key] = new_val
+
+
+def set_shop_page_callback(page):
+    st.session_state.shop_page = page
+
+
+def set_orders_page_callback(page):
+    st.session_state.orders_page = page
+
+
+def run_cart_commands(commands):
+    """Apply Aura's cart commands in order; returns a message for each."""
+    cart = st.session_state.cart
+    catalog = DataManager.catalog()
+    messages = []
+    for command in commands:
+        action = command["action"]
+        if action == "invalid":
+            messages.append(
+                f"I couldn't understand that cart request ({command['error']}).")
+            continue
+        if action == "show_cart":
+            if not len(cart):
+                messages.append("🛒 Your cart is empty.")
+                continue
+            lines = "\n".join(f"- {line['qty']} x {line['name']}"
+                              for line in cart)
+            messages.append(
+                f"🛒 Your cart:\n{lines}\n\n**Total: LKR {cart.amount}**")
+            continue
+
+        # The model often shortens or rewords names ("Legendary Heroes")
+        product_obj = catalog.resolve_name(command["item_name"])
+        if not product_obj:
+            messages.append(
+                f"I couldn't find \"{command['item_name']}\" in the catalog.")
+            continue
+        name = product_obj['name']
+        in_cart = product_obj['id'] in cart.lines
+        try:
+            if action == "add_to_cart":
+                cart.add(product_obj, command["qty"])
+                messages.append(
+                    f"✨ I have added **{command['qty']} x {name}** to your cart!")
+            elif action == "remove_from_cart" or command["qty"] == 0:
+                if in_cart:
+                    cart.remove(product_obj['id'])
+                    messages.append(
+                        f"🗑️ I have removed **{name}** from your cart.")
+                else:
+                    messages.append(f"**{name}** isn't in your cart.")
+            else:
+                if in_cart:
+                    cart.set_qty(product_obj['id'], command["qty"])
+                else:
+                    cart.add(product_obj, command["qty"])
+                messages.append(
+                    f"✨ Your cart now has **{command['qty']} x {name}**.")
+        except ValueError as e:
+            messages.append(f"I couldn't update your cart: {e}.")
+    return messages
+
+
+def apply_chat_command(reply, scanner=None):
+    """Run the cart commands in an Aura reply.
+
+    Without ``scanner`` the complete ``reply`` is scanned here; with one,
+    ``reply`` is the prose that scanner gave back while the reply
+    streamed. Returns ``(prose, messages)``: the reply's prose and one
+    message per command run.
+    """
+    if scanner is None:
+        scanner = CommandScanner()
+        reply = scanner.feed(reply) + scanner.close()
+    prose = reply.strip() if isinstance(reply, str) else ""
+    return prose, run_cart_commands(scanner.commands)
+
+
+def cancel_order_callback(order_id):
+    if DataManager.delete_order(order_id):
+        st.toast(f"Order {order_id} Cancelled", icon="🗑️")
+    else:
+        st.error("Failed to cancel order.")
+
+# ==========================================
+# 🖼️ PART 4: POPUPS (Chat & Cart Only)
+# ==========================================
+
+
+@st.dialog("🛒 Your Cart", width="medium")
+@profiled("cart")
+def open_cart_popup():
+    if not st.session_state.cart:
+        st.info("Your cart is empty. Go add some magic!")
+        return
+    c_head1, c_head2 = st.columns([4, 1])
+    with c_head1:
+        st.write(f"Items: **{len(st.session_state.cart)}**")
+    with c_head2:
+        st.button("🗑️ Empty", on_click=clear_cart_callback,
+                  use_container_width=True)
+    st.divider()
+
+    for item in st.session_state.cart:
+        c1, c2, c3, c4 = st.columns([1, 3, 1.5, 0.5])
+        with c1:
+            icon = get_thumbnail_cache().path(item['image'], "icon")
+            if icon:
+                st.image(icon, width=50)
+            else:
+                st.write("📷")
+        with c2:
+            st.markdown(f"**{item['name']}**")
+            st.caption(f"x {item['qty']}")
+        with c3:
+            st.write(f"LKR {item['price'] * item['qty']}")
+        with c4:
+            st.button("❌", key=f"del_{item['id']}",
+                      on_click=remove_item_callback, args=(item['id'],))
+        st.divider()
+
+    col_total, col_checkout = st.columns([2, 1])
+    with col_total:
+        st.markdown(f"### Total: LKR {st.session_state.cart.amount}")
+    with col_checkout:
+        if st.button("✅ Checkout", type="primary", use_container_width=True):
+            changed = st.session_state.cart.reprice()
+            if changed:
+                st.warning(
+                    f"The catalog changed for {', '.join(changed)}. "
+                    "Please review your cart before checking out.")
+            else:
+                order_id = DataManager.save_order(
+                    st.session_state.cart.to_list())
+                if order_id:
+                    # Celebrated by main() after the rerun closes the dialog.
+                    st.session_state.cart.clear()
+                    st.session_state.placed_order = order_id
+                    st.rerun()
+
+
+@st.dialog("✨ Chat with Aura", width="small")
+@profiled("chat")
+def open_chat_popup():
+    c1, c2 = st.columns([4, 1])
+    with c1:
+        st.caption("Ask about products...")
+    with c2:
+        st.button("🗑️ Clear", help="Clear", on_click=clear_chat_callback)
+
+    memory = st.session_state.chat_memory
+    chat_container = st.container(height=350)
+    # Only the most recent messages are rendered; older ones on request.
+    size = st.session_state.get("chat_window", CHAT_WINDOW)
+    if len(memory) > size:
+        chat_container.button("Show earlier messages",
+                              on_click=show_earlier_callback)
+    elif memory.summary:
+        chat_container.caption(f"Earlier: {memory.summary}")
+    for role, content in memory.window(size):
+        avatar = "🔮" if role == "assistant" else "👤"
+        with chat_container.chat_message(role, avatar=avatar):
+            st.write(content)
+
+    if prompt := st.chat_input("Ask Aura..."):
+        memory.add("user", prompt)
+        with chat_container.chat_message("user", avatar="👤"):
+            st.write(prompt)
+
+        with chat_container.chat_message("assistant", avatar="🔮"):
+            # Summary plus recent turns, within CHAT_HISTORY_TOKENS
+            history_str = memory.prompt_history()
+            # Prose is shown as it arrives; cart commands anywhere in the
+            # reply are pulled out and run once it is complete.
+            if AURA_STREAMING:
+                scanner = CommandScanner()
+                prose, messages = apply_chat_command(st.write_stream(
+                    scanner.stream(stream_ai_response(prompt, history_str))),
+                    scanner)
+            else:
+                with st.spinner("..."):
+                    reply = get_ai_response(prompt, history_str)
+                prose, messages = apply_chat_command(reply)
+                if prose:
+                    st.write(prose)
+
+            for message in messages:
+                st.write(message)
+            memory.add("assistant", "\n\n".join([prose] * bool(prose) +
+                                                 messages))
+
+
+# ==========================================
+# 🖥️ PART 5: MAIN UI
+# ==========================================
+class ProductCards:
+    """The static parts of Shop product cards, per catalog version.
+
+    Category pill, name, description caption and price tag are built once
+    per product and reused until the catalog fingerprint changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fingerprint = None
+        self._cards = {}
+
+    def get(self, catalog, product):
+        with self._lock:
+            if catalog.fingerprint != self.fingerprint:
+                self.fingerprint = catalog.fingerprint
+                self._cards = {}
+            card = self._cards.get(product['id'])
+            if card is None:
+                card = self._cards[product['id']] = {
+                    "pill": "<span class='category-pill'>"
+                            f"{html.escape(str(product.get('category')))}</span>",
+                    "name": product.get('name'),
+                    "desc": (product.get('desc') or "")[:500] + "...",
+                    "price": "<div class='price-tag'>LKR "
+                             f"{html.escape(str(product.get('price')))}</div>",
+                }
+            return card
+
+
+@st.cache_resource
+def get_product_cards():
+    return ProductCards()
+
+
+@st.fragment
+@profiled("shop")
+def render_shop():
+    """The Shop tab. As a fragment, its own widgets (quantity, search,
+    filter, paging) rerun only this function, not the whole page."""
+    with get_profiler().span("render.shop"):
+        products = DataManager.load_products()
+        if products:
+            catalog = DataManager.catalog()
+            f_search, f_cat = st.columns([2, 1])
+            with f_search:
+                search = st.text_input("Search:", key="shop_search",
+                                       placeholder="Name, category or description",
+                                       on_change=set_shop_page_callback, args=(0,))
+            with f_cat:
+                cats = ["All"] + catalog.categories
+                sel_cat = st.selectbox("Filter:", cats, key="shop_category",
+                                       on_change=set_shop_page_callback, args=(0,))
+            if search.strip():
+                filtered = catalog.search(search, len(products))
+                if sel_cat != "All":
+                    filtered = [p for p in filtered if p['category'] == sel_cat]
+            else:
+                filtered = products if sel_cat == "All" else \
+                    catalog.by_category.get(sel_cat, [])
+            st.write("")
+            if not filtered:
+                st.info("No spells match your search.")
+
+            # Only the current page gets widgets and qty_ session keys.
+            page_count = max(1, math.ceil(len(filtered) / SHOP_PAGE_SIZE))
+            page = min(st.session_state.get("shop_page", 0), page_count - 1)
+            start = page * SHOP_PAGE_SIZE
+            visible = filtered[start:start + SHOP_PAGE_SIZE]
+
+            cols = st.columns(3)
+            for i, p in enumerate(visible):
+                with cols[i % 3]:
+                    with st.container():
+                        thumb = get_thumbnail_cache().path(
+                            p.get('image', ''), "card")
+                        if thumb:
+                            st.image(thumb, use_container_width=True)
+                        else:
+                            st.markdown(
+                                "<div style='height:150px; background:rgba(255,255,255,0.05);'></div>", unsafe_allow_html=True)
+
+                        card = get_product_cards().get(catalog, p)
+                        st.markdown(card["pill"], unsafe_allow_html=True)
+                        st.subheader(card["name"])
+                        st.caption(card["desc"])
+                        st.markdown(card["price"], unsafe_allow_html=True)
+
+                        c_qty, c_add = st.columns([1.5, 1.5])
+                        qty_key = f"qty_{p['id']}"
+                        if qty_key not in st.session_state:
+                            st.session_state[qty_key] = 1
+
+                        with c_qty:
+                            b_minus, b_val, b_plus = st.columns(
+                                [1, 1, 1], gap="small")
+                            with b_minus:
+                                st.button(
+                                    "➖", key=f"dec_{p['id']}", on_click=update_qty_callback, args=(qty_key, -1))
+                            with b_val:
+                                st.markdown(
+                                    f"<div class='qty-display'>{st.session_state[qty_key]}</div>", unsafe_allow_html=True)
+                            with b_plus:
+                                st.button(
+                                    "➕", key=f"inc_{p['id']}", on_click=update_qty_callback, args=(qty_key, 1))
+
+                        with c_add:
+                            if st.button("Add to Cart", key=f"btn_{p['id']}", on_click=add_to_cart_callback, args=(
+                                    p, qty_key), use_container_width=True):
+                                # The cart badge lives outside this fragment.
+                                st.rerun()
+
+            if page_count > 1:
+                st.write("")
+                p_prev, p_info, p_next = st.columns([1, 2, 1])
+                with p_prev:
+                    st.button("◀ Prev", key="shop_prev", disabled=page == 0,
+                              on_click=set_shop_page_callback, args=(page - 1,),
+                              use_container_width=True)
+                with p_info:
+                    st.markdown(
+                        f"<div style='text-align:center; padding-top:8px;'>Page {page + 1} of {page_count} · {len(filtered)} spells</div>", unsafe_allow_html=True)
+                with p_next:
+                    st.button("Next ▶", key="shop_next",
+                              disabled=page == page_count - 1,
+                              on_click=set_shop_page_callback, args=(page + 1,),
+                              use_container_width=True)
+        else:
+            st.error("Catalog not loaded.")
+
+
+def main():
+    init_session_state()
+    st.set_page_config(page_title="Dream Spells Store",
+                       page_icon="images/logo/logo.png", layout="wide")
+    load_custom_styles()
+    get_data_store().begin_run()
+    profiler = get_profiler()
+    profiler.begin_run(profiling_enabled())
+    # st.rerun() and st.stop() raise out of the page; close the run anyway
+    # so the next rerun is not merged into this one.
+    try:
+        render_page(profiler)
+    finally:
+        run = profiler.end_run()
+    if run:
+        render_profile(profiler, run)
+
+
+def render_page(profiler):
+    if "placed_order" in st.session_state:
+        st.balloons()
+        st.toast(f"Order {st.session_state.pop('placed_order')} placed!",
+                 icon="🎉")
+
+    with st.sidebar, profiler.span("render.sidebar"):
+        if os.path.exists("images/logo/logo.png"):
+            # Create 3 columns (Spacer | Logo | Spacer) to center it
+            _, col_logo, _ = st.columns([1, 2, 1])
+            with col_logo:
+                st.image("images/logo/logo.png", use_container_width=True)
+        else:
+            st.markdown("## 🧿 Dream Spells")
+
+        st.divider()
+
+        st.markdown("""
+            <div class="user-card">
+                <div style="font-size: 3rem;">👤</div>
+                <h3>Ishara Stanley</h3>
+                <p style="color:#aaa;">Premium Member</p>
+            </div>
+        """, unsafe_allow_html=True)
+
+        st.divider()
+        if st.button("✨ Ask Aura AI", use_container_width=True):
+            open_chat_popup()
+        st.divider()
+        st.info("📍 Shipping to: Kandy, LK")
+
+    # --- HEADER & CART BUTTON ---
+    c_title, c_cart = st.columns([6, 1.2])
+    with c_title:
+        st.title("Dream Spells Collection")
+    with c_cart:
+        cart_count = st.session_state.cart.count
+        cart_label = f"🛒 Cart ({cart_count})" if cart_count > 0 else "🛒 Cart"
+        if st.button(cart_label, use_container_width=True):
+            open_cart_popup()
+
+    st.write("")
+
+    # --- TABS FOR SHOP, ORDERS, STATS ---
+    tab1, tab2, tab3 = st.tabs(["🛍️ Shop", "📦 Orders", "📊 Spending Stats"])
+
+    # === TAB 1: SHOP ===
+    with tab1:
+        render_shop()
+
+    # === TAB 2: ORDERS (Proper Table Layout & Logic) ===
+    with tab2, profiler.span("render.orders"):
+        st.subheader("Order History")
+        f_status, f_dates = st.columns([2, 2])
+        with f_status:
+            statuses = st.multiselect("Status", ORDER_STATUSES,
+                                      key="orders_status", placeholder="All",
+                                      on_change=set_orders_page_callback,
+                                      args=(0,))
+        with f_dates:
+            dates = st.date_input("Date range", value=[], key="orders_dates",
+                                  on_change=set_orders_page_callback, args=(0,))
+        date_from = dates[0].isoformat() if len(dates) > 0 else None
+        date_to = dates[1].isoformat() if len(dates) > 1 else None
+
+        # Only the current page is read from storage and rendered.
+        page = st.session_state.get("orders_page", 0)
+        history, total = DataManager.query_orders(
+            statuses, date_from, date_to, page * ORDERS_PAGE_SIZE,
+            ORDERS_PAGE_SIZE)
+        page_count = max(1, math.ceil(total / ORDERS_PAGE_SIZE))
+        if page >= page_count:
+            page = page_count - 1
+            history, total = DataManager.query_orders(
+                statuses, date_from, date_to, page * ORDERS_PAGE_SIZE,
+                ORDERS_PAGE_SIZE)
+
+        if history:
+            cols = st.columns([1.5, 2.5, 1.5, 1.5, 1.5, 1])
+            headers = ["Ref ID", "Items", "Date", "Price", "Status", "Action"]
+            for col, h in zip(cols, headers):
+                col.markdown(
+                    f"<div style='font-weight:bold; color:#d1c4e9;'>{h}</div>", unsafe_allow_html=True)
+
+            st.markdown(
+                "<hr style='margin:5px 0; border-color:rgba(255,255,255,0.2);'>", unsafe_allow_html=True)
+
+            for order in history:
+                c1, c2, c3, c4, c5, c6 = st.columns([1.5, 2.5, 1.5, 1.5, 1.5, 1])
+
+                status = order.get('status', 'Processing')
+                status_color = "#FFA726"  # Orange
+                can_cancel = False
+
+                if status == "Shipped":
+                    status_color = "#29B6F6"
+                elif status == "Delivered":
+                    status_color = "#66BB6A"
+                elif status == "Processing":
+                    can_cancel = True
+
+                with c1:
+                    st.write(order['order_id'])
+                with c2:
+                    st.write(order_items_text(order))
+                with c3:
+                    st.write(order['date'])
+                with c4:
+                    st.write(f"LKR {order['total']}")
+                with c5:
+                    st.markdown(
+                        f"<span style='color:{status_color}; font-weight:bold;'>{status}</span>", unsafe_allow_html=True)
+
+                with c6:
+                    if can_cancel:
+                        st.button("Cancel", key=f"cancel_{order['order_id']}", help="Cancel Order", on_click=cancel_order_callback, args=(
+                            order['order_id'],))
+                    elif status == "Delivered":
+                        st.write("✅")
+                    elif status == "Shipped":
+                        st.write("🚚")
+                    else:
+                        st.write("-")
+
+                st.markdown(
+                    "<div style='border-bottom:1px solid rgba(255,255,255,0.05); margin-bottom:5px;'></div>", unsafe_allow_html=True)
+
+            if page_count > 1:
+                st.write("")
+                p_prev, p_info, p_next = st.columns([1, 2, 1])
+                with p_prev:
+                    st.button("◀ Prev", key="orders_prev", disabled=page == 0,
+                              on_click=set_orders_page_callback,
+                              args=(page - 1,), use_container_width=True)
+                with p_info:
+                    st.markdown(
+                        f"<div style='text-align:center; padding-top:8px;'>Page {page + 1} of {page_count} · {total} orders</div>", unsafe_allow_html=True)
+                with p_next:
+                    st.button("Next ▶", key="orders_next",
+                              disabled=page == page_count - 1,
+                              on_click=set_orders_page_callback,
+                              args=(page + 1,), use_container_width=True)
+        elif statuses or date_from:
+            st.info("No orders match these filters.")
+        else:
+            st.info("No orders placed yet.")
+
+    # === TAB 3: STATS (Personal Spending) ===
+    with tab3, profiler.span("render.stats"):
+        st.subheader("My Spending Habits")
+        spending = DataManager.spending_stats()
+
+        if spending["count"]:
+            c1, c2 = st.columns(2)
+            c1.metric("Total Spent (LKR)", f"{spending['total']:,}")
+            c2.metric("Total Orders Placed", spending["count"])
+
+            st.divider()
+
+            with profiler.span("stats.pandas"):
+                import pandas as pd
+                spending_trend = pd.Series(spending["by_date"]).sort_index()
+                # Join product IDs to current catalog names; lines without a
+                # known ID keep the name they were bought under.
+                item_spend = pd.Series(spending["by_product"])
+                item_spend = item_spend.groupby(item_spend.index.map(
+                    lambda key: spending["product_names"].get(key, key))).sum()
+
+            st.caption("📅 Spending Timeline")
+            st.line_chart(spending_trend, color="#00e676")
+
+            st.caption("🛍️ Spending by Product")
+            st.bar_chart(item_spend, color="#7c3aed")
+        else:
+            st.info("No purchase history found. Buy something to see stats!")
+
+    st.markdown("<br><br><center style='color:#666'>Dream Spells © 2025</center>",
+                unsafe_allow_html=True)
+
+    # --- DATA STORE METRICS (rendered last so the whole rerun is counted) ---
+    with st.sidebar:
+        with st.expander("📈 Data Store"):
+            store_stats = get_data_store().metrics()
+            m1, m2 = st.columns(2)
+            m1.metric("Reads (rerun)", store_stats["run_reads"])
+            m2.metric("Disk loads (rerun)", store_stats["run_loads"])
+            st.caption(
+                f"Cache hit rate: {store_stats['hit_rate']:.0%} "
+                f"({store_stats['total_hits']} hits / {store_stats['total_loads']} loads)")
+        with st.expander("🔮 Aura"):
+            if "last_prompt_stats" in st.session_state:
+                prompt_stats = st.session_state.last_prompt_stats
+                m1, m2 = st.columns(2)
+                m1.metric("Prompt tokens", f"~{prompt_stats['prompt_tokens']:,}")
+                m2.metric("Latency (s)", f"{prompt_stats.get('latency', 0):.2f}",
+                          help=f"First token after {prompt_stats.get('ttft', 0):.2f}s")
+                st.caption(
+                    f"{prompt_stats['products_sent']} of {prompt_stats['catalog_size']} products, "
+                    f"{prompt_stats['orders_sent']} of {prompt_stats['history_size']} order lines sent, "
+                    f"prompt built in {prompt_stats.get('prompt_ms', 0):.1f} ms")
+            cache_stats = get_response_cache().metrics()
+            st.caption(
+                f"Reply cache: {cache_stats['hit_rate']:.0%} hit rate "
+                f"({cache_stats['hits']} hits / {cache_stats['misses']} misses), "
+                f"saved ~{cache_stats['saved_seconds']:.1f}s and "
+                f"~{cache_stats['saved_tokens']:,} prompt tokens")
+            gateway_stats = get_llm_gateway().metrics()
+            st.caption(
+                f"Gateway: {gateway_stats['in_flight']} in flight, "
+                f"{gateway_stats['queued']} queued, "
+                f"p50/p95/p99 {gateway_stats['p50']:.2f}/"
+                f"{gateway_stats['p95']:.2f}/{gateway_stats['p99']:.2f}s, "
+                f"{gateway_stats['retries']} retries, "
+                f"{gateway_stats['coalesced']} coalesced, "
+                f"{gateway_stats['rejected']} rejected, "
+                f"{gateway_stats['cut_short']} cut short")
+        with st.expander("📦 Write Queue"):
+            writer_stats = get_order_writer().metrics()
+            m1, m2 = st.columns(2)
+            m1.metric("Queued", writer_stats["depth"],
+                      help=f"Deepest: {writer_stats['max_depth']}")
+            m2.metric("Flush p95 (ms)", f"{writer_stats['flush_p95_ms']:.0f}")
+            st.caption(
+                f"{writer_stats['written']} writes in {writer_stats['batches']} "
+                f"batches (~{writer_stats['batch_avg']:.1f} each), "
+                f"flush p50/p99 {writer_stats['flush_p50_ms']:.0f}/"
+                f"{writer_stats['flush_p99_ms']:.0f} ms, queue-to-disk p95 "
+                f"{writer_stats['lag_p95_ms']:.0f} ms, "
+                f"{writer_stats['errors']} errors")
+            if writer_stats["last_error"]:
+                st.caption(f"Last error: {writer_stats['last_error']}")
+
+
+def render_profile(profiler, run):
+    """The "⏱️ Profile" sidebar panel for a finished profiled rerun."""
+    with st.sidebar:
+        with st.expander("⏱️ Profile", expanded=True):
+            m1, m2 = st.columns(2)
+            m1.metric("Rerun (ms)", f"{run['ms']:.0f}")
+            m2.metric("File reads", run["file_reads"],
+                      help=f"{run['file_bytes']:,} bytes")
+            st.dataframe(
+                [{"span": name, **span} for name, span in sorted(
+                    run["spans"].items(), key=lambda kv: -kv[1]["ms"])],
+                hide_index=True, use_container_width=True)
+            dialogs = [r for r in profiler.recent if r["kind"] != "rerun"]
+            if dialogs:
+                st.caption("Recent dialog runs")
+                st.dataframe(
+                    [{"kind": r["kind"], "ms": r["ms"],
+                      "llm ms": r["spans"].get("llm", {}).get("ms", 0)}
+                     for r in dialogs[-5:]],
+                    hide_index=True, use_container_width=True)
+            d1, d2 = st.columns(2)
+            d1.download_button("Prometheus", profiler.prometheus(),
+                               "dream_spells.prom", "text/plain")
+            d2.download_button("JSON lines", profiler.jsonl(),
+                               "dream_spells_profile.jsonl",
+                               "application/x-ndjson")
 
-        st.caption("🛍️ Spending by Product")
-        df_hist['clean_item'] = df_hist['item'].apply(
-            lambda x: x.split(' (x')[0] if ' (x' in x else x)
-        item_spend = df_hist.groupby('clean_item')['price'].sum()
-        st.bar_chart(item_spend, color="#7c3aed")
-    else:
-        st.info("No purchase history found. Buy something to see stats!")
 
-st.markdown("<br><br><center style='color:#666'>Dream Spells © 2025</center>",
-            unsafe_allow_html=True)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""Headless benchmarks for the Dream Spells store.
+
+Drives the real code paths in app.py against a synthetic catalog and
+order history, with the model replaced by an offline backend (the stub,
+the rule-based Aura, or replies recorded earlier with LLM_RECORD), and
+writes p50/p95/p99 latency and throughput per operation to a JSON file
+that can be diffed between releases:
+
+    python benchmarks/run_benchmarks.py --products 2000 --orders 20000 \\
+        --sessions 8 --storage sqlite --out bench-sqlite.json
+
+Each session is a thread, as in a Streamlit server process, except for
+the AppTest reruns, which get a process per session. Checkouts can also
+be spread over several processes (--processes) to exercise the
+cross-process file locks; afterwards every order a session saved must be
+in the history exactly once, and the run fails otherwise. The callbacks
+run against Streamlit's bare-mode session state, which all threads share.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATUSES = ["Processing", "Shipped", "Delivered"]
+
+
+def make_catalog(size, rng):
+    """``size`` products cycling through the real catalog's names and images."""
+    with open(os.path.join(ROOT, "products.json"), "r") as f:
+        base = json.load(f)
+    return [{
+        "id": f"DS-{i + 1:05d}",
+        "name": f"{p['name']} {i + 1}",
+        "category": p["category"],
+        "price": rng.randrange(5, 100) * 100,
+        "desc": p["desc"],
+        "image": os.path.join(ROOT, p["image"]),
+    } for i, p in ((i, base[i % len(base)]) for i in range(size))]
+
+
+def make_history(size, products, rng):
+    """``size`` schema 2 orders spread over the past year, oldest first."""
+    today = date.today()
+    history = []
+    for i in range(size):
+        lines = [{"product_id": p["id"], "name": p["name"],
+                  "qty": rng.randint(1, 3), "unit_price": p["price"]}
+                 for p in rng.sample(products, rng.randint(1, 3))]
+        history.append({
+            "schema": 2,
+            "order_id": f"ORD-{1000 + i}",
+            "date": (today - timedelta(days=365 * (size - i) // size)).isoformat(),
+            "status": rng.choice(STATUSES),
+            "total": sum(l["qty"] * l["unit_price"] for l in lines),
+            "items": lines,
+        })
+    return history
+
+
+def prepare_workdir(args):
+    """Write the synthetic data and settings; app.py reads both at import."""
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dream-spells-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    rng = random.Random(args.seed)
+    products = make_catalog(args.products, rng)
+    with open(os.path.join(workdir, "products.json"), "w") as f:
+        json.dump(products, f)
+    with open(os.path.join(workdir, "purchase_history.json"), "w") as f:
+        json.dump(make_history(args.orders, products, rng), f)
+    os.environ.update({
+        "STORAGE_MODE": args.storage,
+        "SQLITE_PATH": os.path.join(workdir, "dream_spells.db"),
+        "LLM_BACKEND": args.llm_backend,
+        "STUB_LATENCY": str(args.stub_latency),
+        "REPLAY_LATENCY": args.replay_latency,
+        "LLM_RATE_LIMIT": "1000000",
+        "LLM_BURST": "1000000",
+        "STREAMLIT_LOGGER_LEVEL": "error",
+    })
+    for name, path in (("LLM_RECORD", args.llm_record),
+                       ("LLM_REPLAY", args.llm_replay)):
+        if path:
+            os.environ[name] = os.path.abspath(path)
+    os.chdir(workdir)
+    return workdir
+
+
+def import_app():
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def run_sessions(op, sessions, iterations):
+    """Run ``op(session, i)`` from ``sessions`` threads.
+
+    Returns per-call latencies in seconds, the error count and wall time.
+    """
+    latencies = [[] for _ in range(sessions)]
+    errors = [0] * sessions
+
+    def session(s):
+        for i in range(iterations):
+            start = time.perf_counter()
+            try:
+                op(s, i)
+            except Exception:
+                errors[s] += 1
+                continue
+            latencies[s].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=session, args=(s,))
+               for s in range(sessions)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [x for l in latencies for x in l], sum(errors), \
+        time.perf_counter() - start
+
+
+def summarize(app, latencies, errors, wall):
+    ms = [x * 1000 for x in latencies]
+    return {
+        "calls": len(ms),
+        "errors": errors,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": round(app.percentile(ms, 50), 3),
+        "p95_ms": round(app.percentile(ms, 95), 3),
+        "p99_ms": round(app.percentile(ms, 99), 3),
+        "max_ms": round(max(ms), 3) if ms else 0.0,
+        "throughput_per_s": round(len(ms) / wall, 1) if wall else 0.0,
+    }
+
+
+def checkout_batch(sessions, iterations, tag):
+    """Check out ``sessions`` x ``iterations`` one-line carts.
+
+    Runs in the parent process, or in a child when --processes > 1.
+    Returns the latencies, error count, wall time and saved order IDs;
+    the wall time includes draining the write queue.
+    """
+    app = import_app()
+    products = app.DataManager.load_products()
+    saved = [[] for _ in range(sessions)]
+
+    def checkout(s, i):
+        p = products[(s * iterations + i) % len(products)]
+        order_id = app.DataManager.save_order([{
+            "id": p["id"], "name": f"{tag}-{s}-{i}", "qty": 1,
+            "price": p["price"]}])
+        if not order_id:
+            raise RuntimeError("save_order failed")
+        saved[s].append(order_id)
+
+    start = time.perf_counter()
+    latencies, errors, _ = run_sessions(checkout, sessions, iterations)
+    app.get_order_writer().flush()
+    return latencies, errors, time.perf_counter() - start, \
+        [o for l in saved for o in l]
+
+
+def bench_checkouts(app, args, results):
+    before = len(app.DataManager.load_history())
+    if args.processes > 1:
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(args.processes) as pool:
+            start = time.perf_counter()
+            batches = pool.starmap(checkout_batch, [
+                (args.sessions, args.iterations, f"p{p}")
+                for p in range(args.processes)])
+            wall = time.perf_counter() - start
+        # The children wrote behind this process's caches.
+        app.get_data_store().invalidate()
+    else:
+        batch = checkout_batch(args.sessions, args.iterations, "p0")
+        batches, wall = [batch], batch[2]
+    latencies = [x for b in batches for x in b[0]]
+    errors = sum(b[1] for b in batches)
+    saved = [o for b in batches for o in b[3]]
+    results["operations"]["save_order"] = summarize(
+        app, latencies, errors, wall)
+
+    counts = {}
+    for order in app.DataManager.load_history():
+        counts[order["order_id"]] = counts.get(order["order_id"], 0) + 1
+    expected = args.processes * args.sessions * args.iterations
+    check = {
+        "expected": expected,
+        "saved": len(saved),
+        "added": len(counts) - before,
+        "missing": sum(1 for o in saved if o not in counts),
+        "duplicated": sum(1 for n in counts.values() if n > 1),
+    }
+    check["ok"] = (check["saved"] == check["added"] == expected
+                   and not check["missing"] and not check["duplicated"])
+    results["checks"]["concurrent_checkout"] = check
+    if args.processes == 1:
+        results["write_queue"] = app.get_order_writer().metrics()
+    return saved
+
+
+def bench_in_process(app, args, results, saved):
+    import streamlit as st
+
+    products = app.DataManager.load_products()
+    ops = results["operations"]
+    n, it = args.sessions, args.iterations
+
+    def record(name, op, iterations=it):
+        ops[name] = summarize(app, *run_sessions(op, n, iterations))
+
+    record("load_data", lambda s, i: app.DataManager.load_data())
+
+    per_session = [saved[s::n] for s in range(n)]
+
+    def delete_order(s, i):
+        if not app.DataManager.delete_order(per_session[s][i]):
+            raise RuntimeError("delete_order failed")
+    record("delete_order", delete_order,
+           iterations=min(len(l) for l in per_session))
+    app.get_order_writer().flush()
+
+    app.init_session_state()
+    st.session_state.cart = app.Cart()
+
+    def add_to_cart(s, i):
+        p = products[(s * it + i) % len(products)]
+        qty_key = f"qty_{p['id']}"
+        st.session_state[qty_key] = 1
+        app.add_to_cart_callback(p, qty_key)
+    record("add_to_cart_callback", add_to_cart)
+
+    # Prompt construction alone, then the full chat path with the model.
+    # The cart goes into every prompt, so start the chat ops empty.
+    st.session_state.cart = app.Cart()
+    history = "assistant: Welcome back! Ask me about dreamcatchers."
+    record("chat_prompt", lambda s, i: app.prepare_ai_request(
+        f"session {s} question {i}: which spell helps me sleep?", history))
+    record("chat_reply", lambda s, i: app.get_ai_response(
+        f"session {s} question {i}: which spell helps me sleep?", history))
+
+    def chat_command(s, i):
+        p = products[(s * it + i) % len(products)]
+        _, messages = app.apply_chat_command(json.dumps({
+            "action": "add_to_cart", "item_name": p["name"], "qty": 1}))
+        if not messages:
+            raise RuntimeError("command not handled")
+    record("chat_command", chat_command)
+
+    # The rule-based and replayed models answer with the commands
+    # themselves, so whole agent turns can be timed the way the chat
+    # popup runs them: an add and then a remove, which keeps the shared
+    # cart (and so the prompt) small.
+    if args.llm_backend != "stub":
+        st.session_state.cart = app.Cart()
+
+        def chat_agent(s, i):
+            p = products[(s * it + i) % len(products)]
+            for query in (f"add 1 {p['name']} please",
+                          f"remove {p['name']}"):
+                if app.AURA_STREAMING:
+                    scanner = app.CommandScanner()
+                    _, messages = app.apply_chat_command("".join(
+                        scanner.stream(app.stream_ai_response(query, history))),
+                        scanner)
+                else:
+                    _, messages = app.apply_chat_command(
+                        app.get_ai_response(query, history))
+                if not messages:
+                    raise RuntimeError("no cart command in the reply")
+        record("chat_agent", chat_agent)
+    if args.llm_backend == "replay":
+        results["replay"] = dict(app.get_llm_gateway().backend.counters)
+
+
+def rerun_session(reruns):
+    """One AppTest session: a first run, then ``reruns`` timed reruns."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=120)
+    start = time.perf_counter()
+    at.run()
+    first = time.perf_counter() - start
+    latencies, errors = [], 0
+    for _ in range(reruns):
+        start = time.perf_counter()
+        at.run()
+        if at.exception:
+            errors += 1
+        else:
+            latencies.append(time.perf_counter() - start)
+    return first, latencies, errors
+
+
+def bench_reruns(app, args, results):
+    # AppTest is not safe to drive from several threads at once, so each
+    # session gets its own process.
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(args.sessions) as pool:
+        start = time.perf_counter()
+        sessions = pool.map(rerun_session, [args.reruns] * args.sessions)
+        wall = time.perf_counter() - start
+    ops = results["operations"]
+    ops["apptest_first_run"] = summarize(
+        app, [s[0] for s in sessions], 0, wall)
+    ops["apptest_rerun"] = summarize(
+        app, [x for s in sessions for x in s[1]],
+        sum(s[2] for s in sessions), wall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--sessions", type=int, default=4,
+                        help="concurrent sessions (threads)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes checking out concurrently")
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="calls per session for each operation")
+    parser.add_argument("--reruns", type=int, default=5,
+                        help="AppTest reruns per session")
+    parser.add_argument("--storage", default="json",
+                        choices=["json", "journal", "sqlite"])
+    parser.add_argument("--llm-backend", default="stub",
+                        choices=["stub", "rules", "replay"])
+    parser.add_argument("--stub-latency", type=float, default=0.0,
+                        help="seconds the stub or rules model takes per reply")
+    parser.add_argument("--llm-record", help="append every model call to "
+                                             "this JSON lines file")
+    parser.add_argument("--llm-replay", help="recordings for --llm-backend "
+                                             "replay")
+    parser.add_argument("--replay-latency", default="recorded",
+                        help="seconds each replayed reply takes, or "
+                             "'recorded' to reuse the recorded latency")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--workdir", help="defaults to a new temp dir")
+    parser.add_argument("--out", default="benchmark-results.json")
+    args = parser.parse_args()
+    out = os.path.abspath(args.out)
+
+    workdir = prepare_workdir(args)
+    app = import_app()
+    import streamlit
+
+    results = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "streamlit": streamlit.__version__,
+            "workdir": workdir,
+            **{k: v for k, v in vars(args).items()
+               if k not in ("out", "workdir")},
+        },
+        "operations": {},
+        "checks": {},
+        "write_queue": {},
+    }
+    saved = bench_checkouts(app, args, results)
+    bench_in_process(app, args, results, saved)
+    bench_reruns(app, args, results)
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'operation':<22}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'ops/s':>10}")
+    for name, s in results["operations"].items():
+        print(f"{name:<22}{s['calls']:>7}{s['p50_ms']:>10.2f}"
+              f"{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}"
+              f"{s['throughput_per_s']:>10.1f}")
+    check = results["checks"]["concurrent_checkout"]
+    print(f"concurrent checkout: {check['added']}/{check['expected']} "
+          f"orders, {check['missing']} missing, "
+          f"{check['duplicated']} duplicated -> "
+          f"{'OK' if check['ok'] else 'FAILED'}")
+    queue = results["write_queue"]
+    if queue:
+        print(f"write queue: {queue['written']} writes in {queue['batches']} "
+              f"batches, flush p50/p95 {queue['flush_p50_ms']:.1f}/"
+              f"{queue['flush_p95_ms']:.1f} ms, deepest {queue['max_depth']}")
+    replay = results.get("replay")
+    if replay:
+        print(f"replay: {replay['exact']} exact, {replay['query']} by "
+              f"question, {replay['misses']} missing")
+    print(f"results written to {out}")
+    return 0 if check["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+import os
+import shutil
+import sys
+
+import pytest
+import streamlit as st
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+BACKENDS = ["json", "journal", "sqlite"]
+
+
+@pytest.fixture
+def store(request, tmp_path, monkeypatch):
+    """A fresh data directory on the backend named by the parameter
+    (default json), with the real catalog and an empty history."""
+    shutil.copy(os.path.join(ROOT, "products.json"), tmp_path)
+    (tmp_path / "purchase_history.json").write_text("[]")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "STORAGE_MODE", getattr(request, "param", "json"))
+    st.cache_resource.clear()
+    yield app.get_storage()
+    st.cache_resource.clear()
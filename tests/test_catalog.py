@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def products():
+    with open(os.path.join(ROOT, "products.json"), "r") as f:
+        return json.load(f)
+
+
+@pytest.fixture(params=["built", "snapshot"])
+def catalog(request, products, tmp_path):
+    if request.param == "built":
+        return app.Catalog(products)
+    path = str(tmp_path / "catalog.snapshot")
+    app.compile_catalog_snapshot(products, path, "test")
+    return app.SnapshotCatalog(app.CatalogSnapshot(path).products)
+
+
+def resolved(catalog, name):
+    product = catalog.resolve_name(name)
+    return product and product["name"]
+
+
+def test_resolve_exact_name_ignores_case_and_punctuation(catalog):
+    assert resolved(catalog, "love's EMBRACE") == "Love's Embrace"
+
+
+def test_resolve_name_containing_a_product_name(catalog):
+    assert resolved(catalog, "Radiance of the Sun & Flame") == "Sun & Flame"
+    assert resolved(catalog, "Legendary Heroes Unite") == "Legendary Heroes"
+
+
+def test_resolve_similar_name(catalog):
+    assert resolved(catalog, "heavenly hue") == "Heavenly Hues"
+
+
+def test_resolve_single_word_of_one_product(catalog):
+    for word, name in [("Glow", "Radiant Glow"), ("Heroes", "Legendary Heroes"),
+                       ("Twilight", "Serene Twilight"),
+                       ("Rainbow", "Rainbow Harmony")]:
+        assert resolved(catalog, word) == name
+
+
+def test_resolve_unknown_name(catalog):
+    assert resolved(catalog, "Zzyzx Potion") is None
+    assert resolved(catalog, "") is None
@@ -0,0 +1,49 @@
+import threading
+from collections import Counter
+
+import pytest
+
+import app
+from conftest import BACKENDS
+
+SESSIONS = 8
+ORDERS_PER_SESSION = 25
+
+
+@pytest.mark.parametrize("store", BACKENDS, indirect=True)
+def test_concurrent_checkouts_lose_and_duplicate_nothing(store):
+    products = app.DataManager.load_products()
+    saved = [[] for _ in range(SESSIONS)]
+    expected_total = 0
+    carts = []
+    for s in range(SESSIONS):
+        for i in range(ORDERS_PER_SESSION):
+            p = products[(s + i) % len(products)]
+            qty = i % 3 + 1
+            carts.append((s, [{"id": p["id"], "name": p["name"],
+                               "price": p["price"], "qty": qty}]))
+            expected_total += p["price"] * qty
+
+    def session(s):
+        for owner, cart in carts:
+            if owner == s:
+                saved[s].append(app.DataManager.save_order(cart))
+
+    threads = [threading.Thread(target=session, args=(s,))
+               for s in range(SESSIONS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert app.get_order_writer().flush(timeout=30)
+
+    order_ids = [order_id for ids in saved for order_id in ids]
+    assert all(order_ids)
+    assert len(set(order_ids)) == len(order_ids)
+
+    history = store.load_history()
+    stored = Counter(o["order_id"] for o in history)
+    assert set(stored) == set(order_ids)
+    assert max(stored.values()) == 1
+    assert sum(o["total"] for o in history) == expected_total
+    assert app.DataManager.spending_stats()["total"] == expected_total
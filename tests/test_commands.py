@@ -0,0 +1,32 @@
+import json
+
+import streamlit as st
+
+import app
+
+ENVELOPE = {
+    "reply": "Adding that now!",
+    "commands": [
+        {"action": "add_to_cart", "item_name": "Radiant Glow", "qty": 2},
+        "oops",
+        {"item_name": "Earth Tones"},
+    ],
+}
+
+
+def test_envelope_with_bad_elements_keeps_reply_and_valid_commands():
+    commands, reply = app.parse_commands(ENVELOPE)
+    assert reply == "Adding that now!"
+    assert commands[0] == {"action": "add_to_cart",
+                           "item_name": "Radiant Glow", "qty": 2}
+    assert [c["action"] for c in commands[1:]] == ["invalid", "invalid"]
+
+
+def test_mixed_envelope_runs_valid_commands_and_reports_the_rest(store):
+    st.session_state.cart = app.Cart()
+    prose, messages = app.apply_chat_command(json.dumps(ENVELOPE))
+    assert prose == "Adding that now!"
+    assert len(messages) == 3
+    assert "Radiant Glow" in messages[0]
+    assert all("couldn't understand" in m for m in messages[1:])
+    assert [line["qty"] for line in st.session_state.cart.to_list()] == [2]
@@ -0,0 +1,51 @@
+import time
+
+import streamlit as st
+
+import app
+
+
+class StallingBackend(app.ModelBackend):
+    """Streams a few words, then hangs past any deadline."""
+
+    name = "stalling"
+
+    def stream(self, prompt, timeout):
+        yield "Heavenly Hues is"
+        yield " a calming"
+        time.sleep(1)
+        yield " piece."
+
+
+def gateway(backend, timeout):
+    return app.LLMGateway(backend, max_concurrency=2, rate=1000, burst=1000,
+                          timeout=timeout, max_retries=0, max_queue=4)
+
+
+def test_stream_cut_short_by_the_deadline_says_so(store, monkeypatch):
+    llm = gateway(StallingBackend(), timeout=0.3)
+    monkeypatch.setattr(app, "get_llm_gateway", lambda: llm)
+    st.session_state.cart = app.Cart()
+
+    reply = "".join(app.stream_ai_response("tell me about heavenly hues", ""))
+
+    assert reply.startswith("Heavenly Hues is a calming")
+    assert reply.endswith(app.CUT_SHORT_NOTE)
+    assert st.session_state.last_prompt_stats["cut_short"]
+    assert llm.metrics()["cut_short"] == 1
+
+
+def test_stream_failing_before_output_shows_the_error(store, monkeypatch):
+    class Silent(StallingBackend):
+        def stream(self, prompt, timeout):
+            time.sleep(1)
+            yield "late"
+
+    llm = gateway(Silent(), timeout=0.3)
+    monkeypatch.setattr(app, "get_llm_gateway", lambda: llm)
+    st.session_state.cart = app.Cart()
+
+    reply = "".join(app.stream_ai_response("tell me about heavenly hues", ""))
+
+    assert reply == app.ai_error_message(app.GatewayTimeout())
+    assert llm.metrics()["cut_short"] == 0
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import app
+from conftest import BACKENDS
+
+ITEMS = [{"id": "DS-001", "name": "Heavenly Hues", "price": 2500, "qty": 1}]
+
+
+def order(order_id):
+    return {"schema": app.ORDER_SCHEMA_VERSION, "order_id": order_id,
+            "date": "2025-01-01", "status": "Processing", "total": 2500,
+            "items": [{"product_id": "DS-001", "name": "Heavenly Hues",
+                       "qty": 1, "unit_price": 2500}]}
+
+
+def write_stale_spool(directory, entries):
+    """A spool left by a crashed worker (no process holds its lock)."""
+    path = os.path.join(directory, "purchase_history.999999999.queue")
+    with open(path, "w") as f:
+        for seq, (op, value) in enumerate(entries, 1):
+            f.write(json.dumps({"seq": seq, "op": op, "value": value}) + "\n")
+    return path
+
+
+def order_ids():
+    return [o["order_id"] for o in app.get_storage().load_history()]
+
+
+@pytest.mark.parametrize("store", BACKENDS, indirect=True)
+def test_recovery_replays_a_crashed_workers_spool(store, tmp_path):
+    path = write_stale_spool(str(tmp_path), [
+        ("order", order("ORD-1")), ("order", order("ORD-2")),
+        ("cancel", "ORD-1")])
+    writer = app.get_order_writer()
+    assert writer.metrics()["recovered"] == 3
+    assert order_ids() == ["ORD-2"]
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("store", BACKENDS, indirect=True)
+def test_recovery_does_not_bring_back_a_cancelled_order(store, tmp_path):
+    writer = app.get_order_writer()
+    order_id = app.DataManager.save_order(ITEMS)
+    writer.flush()
+    # The order landed but its spool entry survived, e.g. a crash
+    # between the batch and the spool rotation.
+    stale = dict(app.get_storage().load_history()[0])
+    assert app.DataManager.delete_order(order_id)
+    writer.flush()
+    write_stale_spool(str(tmp_path), [("order", stale)])
+    app.OrderWriter(str(tmp_path), 0.001, 100)
+    assert order_ids() == []
+
+
+def test_rotate_keeps_only_unflushed_entries(store, monkeypatch):
+    gates = [threading.Event(), threading.Event()]
+    calls = []
+    write_batch = store.write_batch
+
+    def gated(ops):
+        calls.append(ops)
+        gates[len(calls) - 1].wait(10)
+        write_batch(ops)
+    monkeypatch.setattr(store, "write_batch", gated)
+
+    writer = app.get_order_writer()
+    writer.submit("order", order("ORD-1"), wait=False)
+    while not calls:
+        time.sleep(0.001)
+    writer.submit("order", order("ORD-2"), wait=False)
+    writer.submit("order", order("ORD-3"), wait=False)
+    gates[0].set()
+    while writer.metrics()["batches"] < 1:
+        time.sleep(0.001)
+
+    with open(writer.spool_path) as f:
+        spooled = [json.loads(line)["value"]["order_id"] for line in f]
+    assert spooled == ["ORD-2", "ORD-3"]
+    # The rotated spool is still held, so recovery elsewhere skips it.
+    with open(writer.spool_path, "rb") as f:
+        assert not app.try_lock_file(f.fileno())
+
+    gates[1].set()
+    assert writer.flush(timeout=10)
+    assert os.path.getsize(writer.spool_path) == 0
+    assert order_ids() == ["ORD-1", "ORD-2", "ORD-3"]
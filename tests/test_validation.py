@@ -0,0 +1,20 @@
+import json
+
+import pytest
+
+import app
+
+PRODUCT = {"id": "DS-100", "name": "Moon Glow", "category": "Peace",
+           "price": 2500, "desc": "", "image": ""}
+
+
+def test_validate_product_accepts_a_clean_record():
+    assert app.validate_product(dict(PRODUCT))["price"] == 2500
+
+
+@pytest.mark.parametrize("price", [
+    json.loads("Infinity"), json.loads("-Infinity"), json.loads("NaN"),
+    "1e999"])
+def test_validate_product_rejects_non_finite_prices(price):
+    with pytest.raises(ValueError):
+        app.validate_product({**PRODUCT, "price": price})
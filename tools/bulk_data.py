@@ -0,0 +1,201 @@
+"""Bulk import and export of the Dream Spells catalog and order history.
+
+Streams JSON Lines or CSV into or out of whichever storage backend the
+app is configured for (STORAGE_MODE and friends, from the environment or
+.streamlit/secrets.toml), so run it from the app's directory:
+
+    python tools/bulk_data.py import orders history.jsonl
+    python tools/bulk_data.py export orders history.csv
+    python tools/bulk_data.py export products - --format jsonl | head
+
+Imported rows are validated; invalid rows are reported and skipped, and
+rows whose ID is already stored (or appeared earlier in the input) are
+skipped as duplicates. Input is read one row at a time. The json and
+journal backends still rewrite their history file once per import.
+
+In CSV, products are one row each, and orders are one row per order line
+with the order's fields repeated; an order's rows must be consecutive.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRODUCT_FIELDS = ["id", "name", "category", "price", "desc", "image"]
+ORDER_FIELDS = ["order_id", "date", "status"]
+LINE_FIELDS = ["product_id", "name", "qty", "unit_price"]
+PROGRESS_EVERY = 100000
+
+
+def import_app():
+    sys.path.insert(0, ROOT)
+    import app
+    from streamlit import logger
+    # Cached resources warn when used outside `streamlit run`.
+    logger.set_log_level("error")
+    return app
+
+
+class Counter:
+    """Row counts and rate, with progress on stderr for long runs."""
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.rows = 0
+        self.invalid = 0
+
+    def tick(self):
+        self.rows += 1
+        if self.rows % PROGRESS_EVERY == 0:
+            print(f"{self.label}: {self.rows:,} rows, "
+                  f"{self.rate():,.0f} rows/s", file=sys.stderr)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed else 0.0
+
+
+def open_text(path, mode):
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if ext == ".csv":
+        return "csv"
+    sys.exit(f"Cannot tell the format of {path!r}; pass --format")
+
+
+def read_rows(f, fmt, kind):
+    """Yield ``(where, record)``; JSON lines are parsed by the consumer."""
+    if fmt == "jsonl":
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield f"line {number}", line
+        return
+    reader = csv.DictReader(f)
+    if kind == "products":
+        for number, row in enumerate(reader, 2):
+            yield f"row {number}", row
+        return
+    # Consecutive rows with the same order_id make up one order.
+    order = where = None
+    for number, row in enumerate(reader, 2):
+        if order is None or row.get("order_id") != order["order_id"]:
+            if order is not None:
+                yield where, order
+            order = {field: row.get(field) for field in ORDER_FIELDS}
+            order["items"] = []
+            where = f"row {number}"
+        order["items"].append({field: row.get(field) for field in LINE_FIELDS})
+    if order is not None:
+        yield where, order
+
+
+def validated(rows, validate, counter, max_errors):
+    for where, record in rows:
+        counter.tick()
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+            yield validate(record)
+        except ValueError as e:
+            counter.invalid += 1
+            if counter.invalid <= max_errors:
+                print(f"{where}: {e}", file=sys.stderr)
+
+
+def run_import(app, args):
+    fmt = detect_format(args.path, args.format)
+    validate, load = {
+        "products": (app.validate_product, app.DataManager.import_products),
+        "orders": (app.validate_order, app.DataManager.import_orders),
+    }[args.kind]
+    counter = Counter(f"import {args.kind}")
+    with open_text(args.path, "r") as f:
+        added = load(validated(read_rows(f, fmt, args.kind), validate,
+                               counter, args.max_errors))
+    valid = counter.rows - counter.invalid
+    print(f"import {args.kind}: {counter.rows:,} read, {added:,} added, "
+          f"{valid - added:,} duplicates, {counter.invalid:,} invalid in "
+          f"{counter.elapsed():.1f}s ({counter.rate():,.0f} rows/s) "
+          f"into {app.get_storage().name} storage", file=sys.stderr)
+    return 1 if counter.invalid else 0
+
+
+def write_rows(f, fmt, kind, records, counter):
+    if fmt == "jsonl":
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            counter.tick()
+        return
+    if kind == "products":
+        writer = csv.DictWriter(f, PRODUCT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            counter.tick()
+        return
+    writer = csv.writer(f)
+    writer.writerow(ORDER_FIELDS + LINE_FIELDS)
+    for order in records:
+        head = [order[field] for field in ORDER_FIELDS]
+        for line in order["items"]:
+            writer.writerow(head + [line[field] for field in LINE_FIELDS])
+        counter.tick()
+
+
+def run_export(app, args):
+    fmt = detect_format(args.path, args.format)
+    records = {
+        "products": app.DataManager.export_products,
+        "orders": app.DataManager.export_orders,
+    }[args.kind]()
+    counter = Counter(f"export {args.kind}")
+    with open_text(args.path, "w") as f:
+        write_rows(f, fmt, args.kind, records, counter)
+    print(f"export {args.kind}: {counter.rows:,} rows in "
+          f"{counter.elapsed():.1f}s ({counter.rate():,.0f} rows/s) "
+          f"from {app.get_storage().name} storage", file=sys.stderr)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("kind", choices=["products", "orders"])
+    parser.add_argument("path", help="file to read or write, or - for "
+                                     "stdin/stdout")
+    parser.add_argument("--format", choices=["jsonl", "csv"],
+                        help="defaults to the file extension")
+    parser.add_argument("--max-errors", type=int, default=20,
+                        help="invalid rows to describe on stderr")
+    args = parser.parse_args()
+    app = import_app()
+    try:
+        return (run_import if args.command == "import" else run_export)(
+            app, args)
+    except BrokenPipeError:
+        # Stdout was closed early (e.g. by `head`); silence the final flush.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())